@@ -15,85 +15,205 @@ or implied.
 """
 
 import json
+import sys
+
+
+# Interns low cardinality strings like hostnames, instance ids, RLOCs and states, so all parsed lines share
+# one copy of them and comparing them mostly comes down to an identity check. Lists are interned per item.
+def intern(value):
+    if type(value) is str:
+        return sys.intern(value)
+    if type(value) is list:
+        return [sys.intern(item) if type(item) is str else item for item in value]
+    return value
+
+
+# Base of the compact leaf entries of the parsed structure. The fields are slots instead of dict keys, so
+# the millions of map-cache, database, site, device-tracking and mac entries of a large fabric take a
+# fraction of the memory of dicts. Entries are read like the dicts they replace: [], get(), keys(), items()
+# and in use the dict keys listed in fields. The values of the slots listed in interned are interned.
+class Record:
+    __slots__ = ()
+    fields = ()
+    interned = ()
+    slots = {}
+    intern_flags = ()
+
+    def __init_subclass__(cls):
+        cls.slots = dict(zip(cls.fields, cls.__slots__))
+        cls.intern_flags = tuple([slot in cls.interned for slot in cls.__slots__])
+
+    def __init__(self, *values):
+        for slot, flag, value in zip(self.__slots__, self.intern_flags, values):
+            setattr(self, slot, intern(value) if flag else value)
+
+    def __getitem__(self, key):
+        slot = self.slots.get(key)
+        if slot is None:
+            raise KeyError(key)
+        return getattr(self, slot)
+
+    def __setitem__(self, key, value):
+        slot = self.slots.get(key)
+        if slot is None:
+            raise KeyError(key)
+        setattr(self, slot, value)
+
+    def get(self, key, default=None):
+        slot = self.slots.get(key)
+        if slot is None:
+            return default
+        return getattr(self, slot, default)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def keys(self):
+        return self.fields
+
+    def values(self):
+        return [getattr(self, slot) for slot in self.__slots__]
+
+    def items(self):
+        return list(zip(self.fields, self.values()))
+
+    def as_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict)):
+            return self.as_dict() == dict(other.items())
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+
+class MapCacheEntry(Record):
+    __slots__ = ("RLOC", "Source", "State", "Uptime", "Expired")
+    fields = ("RLOC", "Source", "State", "Uptime", "Expired")
+    interned = ("RLOC", "Source", "State")
+
+
+class DatabaseEntry(Record):
+    __slots__ = ("Conf", "Source", "Dyn_EID", "State", "AF", "RLOC")
+    fields = ("Conf", "Source", "Dyn EID", "State", "AF", "RLOC")
+    interned = ("Conf", "Source", "Dyn_EID", "State", "AF", "RLOC")
+
+
+class SiteEntry(Record):
+    __slots__ = ("Last_Register", "Status", "Last_Time")
+    fields = ("Last Register", "Status", "Last Time")
+    interned = ("Last_Register", "Status")
+
+
+class TrackingEntry(Record):
+    __slots__ = ("mac", "source", "interface", "vlan", "age", "state")
+    fields = ("mac", "source", "interface", "vlan", "age", "state")
+    interned = ("source", "interface", "vlan", "state")
+
+
+class MacEntry(Record):
+    __slots__ = ("Source", "Int")
+    fields = ("Source", "Int")
+    interned = ("Source", "Int")
+
+
+records = {cls.__name__: cls for cls in (MapCacheEntry, DatabaseEntry, SiteEntry, TrackingEntry, MacEntry)}
+
+
+# json.dumps default writing a record as {"__record__": class name, "values": [...]}, record_hook is the
+# json.loads object_hook turning these back into records
+def record_json(obj):
+    if isinstance(obj, Record):
+        return {"__record__": type(obj).__name__, "values": obj.values()}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def record_hook(obj):
+    if "__record__" in obj.keys() and obj["__record__"] in records.keys():
+        return records[obj["__record__"]](*obj["values"])
+    return obj
+
+
+# json.dumps default writing a record as the dict it stands for
+def record_dict(obj):
+    if isinstance(obj, Record):
+        return obj.as_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
 
 
 class Analysis_Core:
     def __init__(self):
         self.Parsed = {}
 
-    def nesting(self, tdt, clist):
-        # print(f"{tdt} {type(clist)}\n")
-        if type(clist[0]) is dict:
-            tdt = clist
+    # Walks path down from tdt creating the missing levels, returns the dict at the end of the path. The
+    # keys of new levels are interned, they are the hostnames, instance ids and vlans shared by many entries.
+    def level(self, tdt, path):
+        for clis in path:
+            nxt = tdt.get(clis)
+            if nxt is None:
+                nxt = {}
+                tdt[intern(clis)] = nxt
+            tdt = nxt
+        return tdt
+
+    # Add function, interface to be called to safely add a leaf to the parsed structure. clist is the path
+    # followed by the leaf, missing levels are created while walking the path once. An entry already at the
+    # path is kept (first write wins), an entry holding None is replaced like a missing one.
+    def add(self, clist):
+        if len(clist) < 2:
             return
-        if clist[0] in tdt.keys():
-            pass
-        else:
-            if type(clist[1]) is dict:
-                tdt[clist[0]] = clist[1]
-                return
-            else:
-                tdt[clist[0]] = {clist[1]: {}}
-        if len(clist) > 2:
-            self.nesting(tdt[clist[0]], clist[1:])
-        else:
-            tdt[clist[0]] = clist[1]
+        tdt = self.level(self.Parsed, clist[:-2])
+        if tdt.get(clist[-2]) is None:
+            tdt[clist[-2]] = clist[-1]
         return
 
-    def oneup(self, tdict, uplevel):
-        ttdict = {}
-        ttdict = {uplevel: tdict}
-        return ttdict
-
-    def buildstruct(self, clist):
-        tdict = clist[-1]
-        for i in range(len(clist) - 2, 0, -1):
-            tdict = self.oneup(tdict, clist[i])
-        return tdict
+    # Adds the rows of a table below prefix, every row is the rest of the path followed by the leaf. Same
+    # result as calling add with prefix + row for every row, but the prefix is only walked once.
+    def add_many(self, prefix, rows):
+        top = None
+        for row in rows:
+            if len(row) < 2:
+                continue
+            if top is None:
+                top = self.level(self.Parsed, prefix)
+            tdt = self.level(top, row[:-2])
+            if tdt.get(row[-2]) is None:
+                tdt[row[-2]] = row[-1]
+        return
 
-        '''Add function , interface to be called to safely add a leaf to the parsed structure'''
+    # Sets label to value in the entry at clist, returns True when the value changed. Nothing is set when
+    # there is no entry at clist.
+    def modify(self, clist, label, value):
+        tdt = self.get(clist)
+        if tdt is None:
+            return False
+        return self.assign(tdt, label, value)
 
-    def add(self, clist):
-        # print(f"test....{self.Parsed}")
-        t = self.get(clist[:-1])
-        # print(f"command {t} {clist[:-1]}")
-        if t is not None:
-            return
-        tlist = []
-        tdict = {}
-        for i, commands in enumerate(clist):
-            tlist.append(commands)
-            if self.get(tlist) is None:
-                # print(f"{tlist} {clist[:-1]}  is empty could append dict here")
-                tdict = self.buildstruct(clist[i:])
-                ttdict = self.get(tlist[:-1])
-                ttdict.update({commands: tdict})
-                # print(f"************** {ttdict} {commands} return")
-                return
-            else:
-                # print(f"{tlist}  {clist[:-1]} is not empty ")
-                tdict = self.get(tlist[:-1])
-                if commands in tdict.keys():
-                    # print(f"{commands} found in keys")
-                    pass
-                else:
-                    # print(f"{commands} not found in keys {clist[:-1]}, it new!")
-                    tdict = self.buildstruct(clist[i:])
-                    ttdict = self.get(tlist[:-1])
-                    ttdict[commands] = tdict
+    # Like modify, but creates the entry at clist when it is missing
+    def upsert(self, clist, label, value):
+        return self.assign(self.level(self.Parsed, clist), label, value)
 
-    def modify(self, clist, label, value):
-        oldval = self.get(clist)
-        oldval[label] = value
-        passalong = [*clist, oldval]
-        self.add(passalong)
-        return
+    def assign(self, tdt, label, value):
+        if label in tdt.keys() and tdt[label] == value:
+            return False
+        tdt[label] = value
+        return True
 
     # Function to print out data structure as formatted json
     def printit(self):
         print("\n" + "*" * 80)
         print("          Raw Data:")
-        print(json.dumps(self.Parsed, indent=4))
+        print(json.dumps(self.Parsed, indent=4, default=record_dict))
         return
 
     def get(self, clist):
@@ -0,0 +1,279 @@
+"""Copyright (c) 2021 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+import sys
+import getopt
+import builtins
+import contextlib
+import http.client
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import AnalysisCore
+import DNAC_Connector
+import SDA_Digger
+
+# End to end benchmark of the fabric import and the menu options against MockDnac. For every fabric size
+# a MockDnac process is started, SDA Digger runs the stages in this process and for every stage the wall
+# time, the API calls MockDnac received and the peak memory allocated by SDA Digger (tracemalloc) are
+# reported. Memory tracing slows down the parsing, use -t for timings without it.
+#
+# python Benchmark.py -s 50,500,2000 -w 4 -l 0.01 -j 2
+#
+# With -a only the parsed data structure is benchmarked: rows map-cache entries spread over 100 edges are
+# added to an Analysis_Core, added again (the entries exist already), read back and added as one table
+# per edge with add_many. Last the memory the entries take is compared for dict and record leaves.
+#
+# python Benchmark.py -a 1000000
+
+stages = [("import", None), ("1 session", SDA_Digger.SessionAnalysis), ("2 database", SDA_Digger.DatabaseAnalysis),
+          ("3 map-cache", SDA_Digger.MapCacheAnalysis), ("4 reachability", SDA_Digger.ReachabilityAnalysis),
+          ("5 auth/cts", SDA_Digger.CTSAnalysis), ("7 mcast", SDA_Digger.McastUnderlay)]
+
+
+def start_mock(devices, mockargs):
+    mockpy = os.path.join(os.path.dirname(os.path.abspath(__file__)), "MockDnac.py")
+    proc = subprocess.Popen([sys.executable, mockpy, "-n", str(devices), *mockargs], stdout=subprocess.PIPE,
+                            universal_newlines=True)
+    line = proc.stdout.readline()
+    port = re.findall(r":(\d+) ", line)
+    if len(port) == 0:
+        proc.kill()
+        print(f"MockDnac did not start: {line}")
+        exit()
+    return proc, int(port[0])
+
+
+def mock_call(port, method, path):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    conn.request(method, path, None if method == "GET" else b"", {"content-type": "application/json"})
+    data = json.loads(conn.getresponse().read())
+    conn.close()
+    return data
+
+
+# Runs one stage quietly, answering "n" to the print outputs question of the menu options
+def run_stage(function, *args):
+    answer = builtins.input
+    builtins.input = lambda prompt="": "n"
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            function(*args)
+    finally:
+        builtins.input = answer
+    return
+
+
+def import_fabric(state):
+    state["dnac_core"] = AnalysisCore.Analysis_Core()
+    state["dnac"].checker.dnac_core = state["dnac_core"]
+    SDA_Digger.build_hierarch(state["dnac"], state["dnac_core"])
+    SDA_Digger.Build_Lisp_Fabric(state["dnac"], state["dnac_core"], "MockFabric")
+    return
+
+
+def measure(port, memory, function, *args):
+    mock_call(port, "POST", "/mock/reset")
+    if memory is True:
+        tracemalloc.start()
+    start = time.time()
+    run_stage(function, *args)
+    wall = time.time() - start
+    peak = None
+    if memory is True:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return wall, mock_call(port, "GET", "/mock/stats"), peak
+
+
+def benchmark(devices, workers, memory, mockargs):
+    proc, port = start_mock(devices, mockargs)
+    directory = tempfile.mkdtemp(prefix="sda_bench")
+    rows = []
+    try:
+        state = {}
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            state["dnac"] = DNAC_Connector.DnacCon(f"http://127.0.0.1:{port}", "admin", "admin", directory)
+        state["dnac"].workers = workers
+        state["dnac"].pool.size = max(state["dnac"].pool.size, workers + 2)
+        for name, function in stages:
+            if function is None:
+                result = measure(port, memory, import_fabric, state)
+            else:
+                result = measure(port, memory, function, state["dnac"], state["dnac_core"])
+            rows.append((devices, name, *result))
+            print_row(rows[-1])
+        state["dnac"].logger.close()
+    finally:
+        proc.kill()
+        shutil.rmtree(directory, ignore_errors=True)
+    return rows
+
+
+# Copy of Analysis_Core.add before it walked the tree once, every level is looked up from the root again so
+# an insert costs O(depth^2). Only kept as the baseline of core_benchmark.
+class LegacyCore:
+    def __init__(self):
+        self.Parsed = {}
+
+    def oneup(self, tdict, uplevel):
+        return {uplevel: tdict}
+
+    def buildstruct(self, clist):
+        tdict = clist[-1]
+        for i in range(len(clist) - 2, 0, -1):
+            tdict = self.oneup(tdict, clist[i])
+        return tdict
+
+    def add(self, clist):
+        t = self.get(clist[:-1])
+        if t is not None:
+            return
+        tlist = []
+        for i, commands in enumerate(clist):
+            tlist.append(commands)
+            if self.get(tlist) is None:
+                tdict = self.buildstruct(clist[i:])
+                ttdict = self.get(tlist[:-1])
+                ttdict.update({commands: tdict})
+                return
+            else:
+                tdict = self.get(tlist[:-1])
+                if commands not in tdict.keys():
+                    tdict = self.buildstruct(clist[i:])
+                    ttdict = self.get(tlist[:-1])
+                    ttdict[commands] = tdict
+
+    def get(self, clist):
+        tdt = self.Parsed
+        for clis in clist:
+            if clis in tdt.keys():
+                tdt = tdt[clis]
+            else:
+                return None
+        return tdt
+
+
+def core_benchmark(rows):
+    hosts = [f"edge{k}" for k in range(100)]
+    entries = []
+    for k in range(rows):
+        eid = f"10.{16 + k // 65536}.{(k // 256) % 256}.{k % 256}/32"
+        entries.append((hosts[k % len(hosts)], eid, {"RLOC": "192.168.0.1", "Source": "map-reply",
+                                                     "State": "complete", "Uptime": "00:10:00", "Expired": "never"}))
+    print(f"{'rows':>9}  {'operation':<12}{'wall s':>9}{'rows/s':>12}")
+    legacy = LegacyCore()
+    start = time.time()
+    for host, eid, tdict in entries:
+        legacy.add(["lisp", "map-cache", host, "4097", eid, tdict])
+    wall = time.time() - start
+    print(f"{rows:>9}  {'add legacy':<12}{wall:>9.2f}{rows / max(wall, 1e-9):>12.0f}")
+    legacy = None
+    dnac_core = AnalysisCore.Analysis_Core()
+    for name in ("add", "add again", "get"):
+        start = time.time()
+        if name == "get":
+            for host, eid, tdict in entries:
+                dnac_core.get(["lisp", "map-cache", host, "4097", eid])
+        else:
+            for host, eid, tdict in entries:
+                dnac_core.add(["lisp", "map-cache", host, "4097", eid, tdict])
+        wall = time.time() - start
+        print(f"{rows:>9}  {name:<12}{wall:>9.2f}{rows / max(wall, 1e-9):>12.0f}")
+    # the same rows as one table per edge
+    tables = {}
+    for host, eid, tdict in entries:
+        tables.setdefault(host, []).append([eid, tdict])
+    dnac_core = AnalysisCore.Analysis_Core()
+    start = time.time()
+    for host in tables.keys():
+        dnac_core.add_many(["lisp", "map-cache", host, "4097"], tables[host])
+    wall = time.time() - start
+    print(f"{rows:>9}  {'add_many':<12}{wall:>9.2f}{rows / max(wall, 1e-9):>12.0f}")
+    entries = tables = dnac_core = None
+    # memory of the map-cache entries as dicts, as dicts with interned values and as records (which intern),
+    # the values are split from a line like when parsing
+    for name in ("dict", "interned", "record"):
+        tracemalloc.start()
+        dnac_core = AnalysisCore.Analysis_Core()
+        for k in range(rows):
+            eid = f"10.{16 + k // 65536}.{(k // 256) % 256}.{k % 256}/32"
+            lsp = f"192.168.0.{k % 200 + 1} map-reply complete 00:10:00 never".split()
+            if name == "dict":
+                tdict = {"RLOC": lsp[0], "Source": lsp[1], "State": lsp[2], "Uptime": lsp[3], "Expired": lsp[4]}
+            elif name == "interned":
+                tdict = {"RLOC": AnalysisCore.intern(lsp[0]), "Source": AnalysisCore.intern(lsp[1]),
+                         "State": AnalysisCore.intern(lsp[2]), "Uptime": lsp[3], "Expired": lsp[4]}
+            else:
+                tdict = AnalysisCore.MapCacheEntry(*lsp)
+            dnac_core.add(["lisp", "map-cache", hosts[k % len(hosts)], "4097", eid, tdict])
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        dnac_core = None
+        print(f"{rows:>9}  {'mem ' + name:<12}{memory / 1024 / 1024:>8.1f}M{memory / rows:>10.0f} B")
+    return
+
+
+def print_row(row):
+    devices, name, wall, calls, peak = row
+    total = sum([calls[family] for family in calls.keys() if family != "429"])
+    cli = f"{calls.get('cli', 0)}/{calls.get('task', 0)}/{calls.get('file', 0)}"
+    memory = "-" if peak is None else f"{peak / 1024 / 1024:.1f}"
+    print(f"{devices:>7}  {name:<16}{wall:>9.2f}{total:>8}  {cli:<16}{calls.get('429', 0):>5}{memory:>10}")
+    return
+
+
+def main(argv):
+    usage = 'Benchmark.py -s <sizes, default 50,500,2000> -w <jobs> -l <latency> -j <job duration> ' \
+            '-r <cli requests per minute> -e <endpoints per edge> -m <map-cache entries> -t (no memory tracing) ' \
+            '-a <rows, parsed data structure only>'
+    try:
+        opts, args = getopt.getopt(argv, "hts:w:l:j:r:e:m:a:")
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    sizes = [50, 500, 2000]
+    workers = 4
+    memory = True
+    mockargs = []
+    for opt, arg in opts:
+        if opt == "-h":
+            print(usage)
+            sys.exit()
+        elif opt == "-s":
+            sizes = [int(size) for size in arg.split(",")]
+        elif opt == "-w":
+            workers = int(arg)
+        elif opt == "-t":
+            memory = False
+        elif opt in ("-l", "-j", "-r", "-e", "-m"):
+            mockargs.extend([opt, arg])
+        elif opt == "-a":
+            core_benchmark(int(arg))
+            return
+    print(f"{'devices':>7}  {'stage':<16}{'wall s':>9}{'calls':>8}  {'cli/task/file':<16}{'429':>5}{'peak MB':>10}")
+    for size in sizes:
+        benchmark(size, workers, memory, mockargs)
+    return
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,193 @@
+"""Copyright (c) 2021 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+import atexit
+import collections
+import gzip
+import json
+import threading
+import time
+import urllib.parse
+
+# A cassette holds the HTTP exchanges of a session with DNAC, one json line per exchange with the method,
+# path, request body, response status, Retry-After header, response body and the time the response took.
+# The server name, request headers and the token are never written to it. Cassettes ending in .gz are
+# compressed. The Recorder and Player stand in for the ConnectionPool of DnacCon.
+
+
+def cassette_open(filename, mode):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, f"{mode}t", encoding="utf-8")
+    return open(filename, mode, encoding="utf-8")
+
+
+def url_path(url):
+    parts = urllib.parse.urlsplit(url)
+    if parts.query:
+        return f"{parts.path}?{parts.query}"
+    return parts.path
+
+
+# Replaces the token in the response of the token request
+def scrub(path, content):
+    if not path.endswith("/auth/token"):
+        return content
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return content
+    if type(data) is dict and "Token" in data.keys():
+        data["Token"] = "scrubbed"
+    return json.dumps(data).encode("utf-8")
+
+
+# Passes the requests on to a ConnectionPool and writes every exchange to the cassette
+class Recorder:
+    def __init__(self, pool, filename):
+        self.pool = pool
+        self.filename = filename
+        self.fd = cassette_open(filename, "w")
+        self.lock = threading.Lock()
+        self.start = time.time()
+        atexit.register(self.close)
+
+    # the number of connections is the one of the pool underneath
+    @property
+    def size(self):
+        return self.pool.size
+
+    @size.setter
+    def size(self, size):
+        self.pool.size = size
+
+    def write(self, method, url, body, res, content, start):
+        path = url_path(url)
+        content = scrub(path, content)
+        entry = {"method": method, "url": path, "body": body, "status": res.status,
+                 "retry_after": res.getheader("Retry-After"), "time": round(start - self.start, 3),
+                 "duration": round(time.time() - start, 3),
+                 "content": content.decode("utf-8", errors="surrogateescape")}
+        with self.lock:
+            if self.fd is not None:
+                self.fd.write(json.dumps(entry) + "\n")
+        return
+
+    def request(self, method, url, body, headers):
+        start = time.time()
+        res, content = self.pool.request(method, url, body, headers)
+        self.write(method, url, body, res, content, start)
+        return res, content
+
+    def stream(self, method, url, body, headers, chunk=64 * 1024):
+        start = time.time()
+        body_stream = self.pool.stream(method, url, body, headers, chunk)
+        res = next(body_stream)
+        yield res
+        chunks = []
+        try:
+            for data in body_stream:
+                chunks.append(data)
+                yield data
+        except GeneratorExit:
+            # the reader stops at the end of the json, the rest of the body is recorded as well
+            chunks.extend(body_stream)
+            self.write(method, url, body, res, b"".join(chunks), start)
+            raise
+        self.write(method, url, body, res, b"".join(chunks), start)
+        return
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                self.fd.close()
+                self.fd = None
+        return
+
+
+class CassetteResponse:
+    def __init__(self, status, retry_after):
+        self.status = status
+        self.retry_after = retry_after
+
+    def getheader(self, name, default=None):
+        if name.lower() == "retry-after" and self.retry_after is not None:
+            return self.retry_after
+        return default
+
+
+# Answers the requests from a cassette. Requests are matched on method, path and body, identical requests
+# get the recorded responses in the order they were recorded and the last one once these run out (a task
+# polled more often then during the recording stays finished). With realtime every response takes as long
+# as it did when recorded, otherwise responses are immediate and recorded 429s are skipped. How commands
+# and devices were cut into Command Runner jobs depends on timing, jobs holds the (commands, devices) of
+# the recorded read-requests in order so the CommandQueue can cut the same jobs.
+class Player:
+    def __init__(self, filename, realtime=False):
+        self.filename = filename
+        self.realtime = realtime
+        self.size = 4
+        self.exchanges = {}
+        self.jobs = collections.deque()
+        self.lock = threading.Lock()
+        try:
+            fd = cassette_open(filename, "r")
+        except OSError as err:
+            print(f"Unable to read cassette {filename}: {err}, exiting")
+            exit()
+        with fd:
+            try:
+                for line in fd:
+                    entry = json.loads(line)
+                    key = (entry["method"], entry["url"], entry["body"])
+                    if key not in self.exchanges.keys():
+                        self.exchanges[key] = collections.deque()
+                    self.exchanges[key].append(entry)
+                    if entry["url"].endswith("/cli/read-request") and entry["status"] != 429:
+                        job = json.loads(entry["body"])
+                        self.jobs.append((job["commands"], job["deviceUuids"]))
+            except (ValueError, EOFError, OSError):
+                # end of a cassette that was not closed properly, the exchanges read so far are used
+                pass
+
+    def next(self, method, url, body):
+        key = (method, url_path(url), body)
+        with self.lock:
+            entries = self.exchanges.get(key)
+            if entries is None:
+                entry = None
+            else:
+                while len(entries) > 1 and entries[0]["status"] == 429 and self.realtime is False:
+                    entries.popleft()
+                entry = entries[0]
+                if len(entries) > 1:
+                    entries.popleft()
+        if entry is None:
+            print(f"Request {method} {key[1]} not found in cassette {self.filename}, exiting")
+            exit()
+        if self.realtime is True:
+            time.sleep(entry["duration"])
+        content = entry["content"].encode("utf-8", errors="surrogateescape")
+        return CassetteResponse(entry["status"], entry["retry_after"]), content
+
+    def request(self, method, url, body, headers):
+        return self.next(method, url, body)
+
+    def stream(self, method, url, body, headers, chunk=64 * 1024):
+        res, content = self.next(method, url, body)
+        yield res
+        for offset in range(0, len(content), chunk):
+            yield content[offset:offset + chunk]
+        return
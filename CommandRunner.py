@@ -0,0 +1,515 @@
+"""Copyright (c) 2021 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+import codecs
+import heapq
+import json
+import queue
+import random
+import re
+import threading
+import time
+
+
+# Picks the number of devices and commands per Command Runner job. Batches start at the historic 5 devices
+# and 4 commands, grow while the job turnaround stays close to the fastest seen and shrink on API rate
+# limiting (429), slow jobs or very large result files.
+class CommandBatcher:
+    def __init__(self):
+        self.devs = 5
+        self.cmds = 4
+        # upper bounds for a single read-request, lower them if DNAC rejects larger requests
+        self.max_devs = 100
+        self.max_cmds = 5
+        self.max_size = 20 * 1024 * 1024
+        # jobs taking longer then this (in seconds) are handled like a timeout
+        self.slow = 30
+        self.base = None
+        self.lock = threading.Lock()
+
+    def shrink(self):
+        with self.lock:
+            self.devs = max(1, self.devs // 2)
+            self.cmds = max(1, self.cmds // 2)
+        return
+
+    # Adjusts the batch sizes to a finished job, size is the total length of its outputs
+    def record(self, duration, size):
+        if duration > self.slow:
+            self.shrink()
+            return
+        with self.lock:
+            if self.base is None or duration < self.base:
+                self.base = duration
+            if size > self.max_size:
+                self.devs = max(1, self.devs // 2)
+            elif duration <= self.base * 1.5 + 1:
+                self.devs = min(self.max_devs, self.devs * 2)
+                self.cmds = min(self.max_cmds, self.cmds + 1)
+        return
+
+
+# Decodes a json list from an iterable of byte chunks and yields the list elements as soon as they are
+# complete, only the element being decoded is kept in memory. A failed attempt to decode an element is
+# only repeated once the buffered data has doubled, so large elements are not decoded over and over.
+def stream_items(chunks):
+    decoder = json.JSONDecoder()
+    utf = codecs.getincrementaldecoder("utf-8")()
+    pieces = []
+    size = 0
+    need = 0
+    started = False
+    ended = False
+    chunks = iter(chunks)
+    while not ended:
+        try:
+            text = utf.decode(next(chunks))
+        except StopIteration:
+            text = utf.decode(b"", final=True)
+            ended = True
+        pieces.append(text)
+        size = size + len(text)
+        if size < need and not ended:
+            continue
+        buf = "".join(pieces)
+        pos = 0
+        need = 0
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos = pos + 1
+            if pos >= len(buf):
+                break
+            if not started:
+                started = True
+                if buf[pos] == "[":
+                    pos = pos + 1
+                    continue
+            if buf[pos] == "]":
+                return
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if ended:
+                    raise
+                need = 2 * (len(buf) - pos)
+                break
+            yield item
+        pieces = [buf[pos:]]
+        size = len(pieces[0])
+    return
+
+
+# Checks if a command output received from Command Runner is complete. Outputs are marked as truncated when
+# the first line is not the command, when other outputs of the device end in a prompt and this one does
+# not, when a known header is missing or when an "instance *" command returned less "Output for router
+# lisp" sections then the device has instances configured for that address family.
+class OutputChecker:
+    headers = [(r"^show lisp session$", r"Sessions for VRF"), (r"^sh(ow)? ip route$", r"Codes:")]
+    permanent = r".*(Invalid input|Incomplete command|Ambiguous command|Unrecognized command|not supported)"
+
+    def __init__(self):
+        self.dnac_core = None
+
+    def prompted(self, outputs):
+        for command in outputs:
+            if re.search(r"\S+#\s*$", outputs[command]):
+                return True
+        return False
+
+    # Failures that will not go away by running the command again
+    def transient(self, reason):
+        return re.match(self.permanent, reason, re.S) is None
+
+    def sections(self, hostname, command, output):
+        split = command.split()
+        if "*" not in split or self.dnac_core is None:
+            return True
+        instances = self.dnac_core.get(["lisp", "config", hostname, "instances"])
+        if instances is None:
+            return True
+        afs = [part for part in split if part in ("ethernet", "ipv4", "ipv6")]
+        if len(afs) == 0:
+            return True
+        expected = len([instance for instance in instances if instances[instance].get("AF") == afs[0]])
+        found = len(re.findall(r"^Output for router lisp", output, re.M))
+        return found >= expected
+
+    def state(self, hostname, command, output, prompted):
+        firstline = output.split("\n")[0]
+        if command.strip() not in firstline:
+            return "truncated"
+        if prompted and not re.search(r"\S+#\s*$", output):
+            return "truncated"
+        for cmdre, header in self.headers:
+            if re.match(cmdre, command.strip()) and not re.search(header, output):
+                return "truncated"
+        if not self.sections(hostname, command, output):
+            return "truncated"
+        return "complete"
+
+
+# Work queue of a command_run call. Jobs are cut from groups of (commands, devices) using the batch sizes of
+# the batcher at the moment a job is requested. Commands that returned no, failed or incomplete output on a
+# device are put back as a new group for that device only, after a backoff, until the command failed
+# attempts + 1 times on the device. Retry groups that are due are handed out before the remaining first
+# pass work. Commands DNAC rejected (invalid or blacklisted commands) are not retried. The output of the
+# last attempt is kept as "incomplete" when it is still truncated, the checks can be wrong about a device.
+class CommandQueue:
+    WAIT = "wait"
+
+    def __init__(self, dnac, commands, devices):
+        self.dnac = dnac
+        self.attempts = 3
+        self.backoff = 5
+        self.groups = [{"commands": list(commands), "devices": list(devices), "ready": 0, "chunk": None, "c": 0}]
+        self.tries = {}
+        self.failed = {}
+        self.incomplete = {}
+        self.hosts = {dnac.topo['devices'][dev]: dev for dev in devices}
+        self.outstanding = 0
+        self.lock = threading.Lock()
+
+    # Cuts the next recorded job of a replayed session from the groups, returns None when it is not queued
+    # (yet). Retries are cut when they were recorded, without waiting for them to be ready.
+    def planned_job(self):
+        cmds, devs = self.dnac.jobs[0]
+        for group in self.groups:
+            if group["chunk"] is None:
+                if group["commands"][:len(cmds)] != cmds or not set(devs) <= set(group["devices"]):
+                    continue
+                group["chunk"] = list(devs)
+                group["devices"] = [dev for dev in group["devices"] if dev not in devs]
+                group["c"] = 0
+            elif group["chunk"] != devs or group["commands"][group["c"]:group["c"] + len(cmds)] != cmds:
+                continue
+            group["c"] = group["c"] + len(cmds)
+            if group["c"] >= len(group["commands"]):
+                group["chunk"] = None
+                if len(group["devices"]) == 0:
+                    self.groups.remove(group)
+            self.dnac.jobs.popleft()
+            return cmds, list(devs)
+        return None
+
+    # Returns the next (commands, devices) job, WAIT when only retries that are not due yet (or jobs still
+    # running) are left and None when all work is done
+    def next_job(self):
+        batcher = self.dnac.batcher
+        with self.lock:
+            if self.dnac.jobs:
+                # replay, the jobs are cut as recorded unless the session went a different way
+                job = self.planned_job()
+                if job is not None:
+                    self.outstanding = self.outstanding + 1
+                    return job
+                if self.outstanding > 0:
+                    return self.WAIT
+            now = time.time()
+            for group in list(self.groups):
+                if group["chunk"] is None and (len(group["devices"]) == 0 or len(group["commands"]) == 0):
+                    # nothing to run for this group, DNAC rejects a read-request without devices
+                    self.groups.remove(group)
+                    continue
+                if group["ready"] > now:
+                    continue
+                if group["chunk"] is None:
+                    group["chunk"] = group["devices"][:batcher.devs]
+                    group["devices"] = group["devices"][len(group["chunk"]):]
+                    group["c"] = 0
+                cmds = group["commands"][group["c"]:group["c"] + batcher.cmds]
+                group["c"] = group["c"] + len(cmds)
+                devs = group["chunk"]
+                if group["c"] >= len(group["commands"]):
+                    group["chunk"] = None
+                    if len(group["devices"]) == 0:
+                        self.groups.remove(group)
+                self.outstanding = self.outstanding + 1
+                return cmds, devs
+            if len(self.groups) == 0 and self.outstanding == 0:
+                return None
+        return self.WAIT
+
+    def wait_time(self):
+        with self.lock:
+            if len(self.groups) == 0:
+                return 0.5
+            return min(0.5, max(0, min([group["ready"] for group in self.groups]) - time.time()))
+
+    # Marks the truncated outputs of a device that were the last attempt of their command as incomplete,
+    # these are not retried and are logged and parsed like complete outputs
+    def settle(self, device):
+        with self.lock:
+            for res in device:
+                if res["state"] != "truncated" or res["host"] not in self.hosts.keys():
+                    continue
+                if self.tries.get((self.hosts[res["host"]], res["command"]), 0) >= self.attempts:
+                    res["state"] = "incomplete"
+        return
+
+    # Registers the results of a job, queues the commands without complete output for another attempt and
+    # returns the complete (and incomplete) outputs
+    def complete(self, job, ret):
+        cmds, devs = job
+        received = set()
+        rejected = set()
+        accepted = []
+        for res in ret:
+            state = res.get("state", "complete")
+            if state in ("complete", "incomplete"):
+                received.add((res["host"], res.get("command")))
+                accepted.append(res)
+            if state == "incomplete":
+                print(f"\nCommand runner output of {res.get('command')} on {res['host']} is still incomplete after "
+                      f"{self.attempts + 1} attempts, keeping it")
+                with self.lock:
+                    self.incomplete.setdefault(res["host"], []).append(res.get("command"))
+            elif state == "rejected":
+                rejected.add((res["host"], res.get("command")))
+                print(f"\nCommand runner rejected {res.get('command')} on {res['host']}: {res['output'].strip()}")
+        with self.lock:
+            self.outstanding = self.outstanding - 1
+            for dev in devs:
+                hostname = self.dnac.topo['devices'][dev]
+                missing = []
+                tries = 0
+                for cmd in cmds:
+                    if (hostname, cmd) in received:
+                        continue
+                    if (hostname, cmd) in rejected:
+                        self.failed.setdefault(hostname, []).append(cmd)
+                        continue
+                    self.tries[(dev, cmd)] = self.tries.get((dev, cmd), 0) + 1
+                    if self.tries[(dev, cmd)] > self.attempts:
+                        self.failed.setdefault(hostname, []).append(cmd)
+                    else:
+                        missing.append(cmd)
+                        tries = max(tries, self.tries[(dev, cmd)])
+                if len(missing) == 0:
+                    continue
+                ready = time.time() + self.backoff * 2 ** (tries - 1)
+                for group in self.groups:
+                    # join a retry for the same commands that has not started yet
+                    if group["ready"] > time.time() and group["chunk"] is None and group["commands"] == missing:
+                        group["devices"].append(dev)
+                        group["ready"] = max(group["ready"], ready)
+                        break
+                else:
+                    self.groups.insert(0, {"commands": missing, "devices": [dev], "ready": ready, "chunk": None,
+                                           "c": 0})
+                print(f"\nCommand runner returned no or incomplete output for {len(missing)} command(s) on {hostname}"
+                      f", retrying")
+        return accepted
+
+
+# Decides when Command Runner tasks are checked. The first check is done quickly, after that the wait
+# between checks grows exponentially (with some jitter so tasks do not line up) up to max_wait. Once the
+# usual job duration is known, checks before most jobs have finished are skipped.
+class TaskPoller:
+    def __init__(self):
+        self.first = 0.5
+        self.factor = 1.5
+        self.max_wait = 10
+        self.timeout = 300
+        self.expected = None
+        self.lock = threading.Lock()
+
+    def delay(self, elapsed, checks):
+        wait = min(self.max_wait, self.first * self.factor ** checks)
+        if self.expected is not None and elapsed + wait < self.expected * 0.8:
+            wait = self.expected * 0.8 - elapsed
+        return wait * random.uniform(0.8, 1.2)
+
+    def pending(self, elapsed, checks):
+        if checks % 5 == 4:
+            print(f"o", end="")
+        if elapsed > self.timeout:
+            print(f"Timeout exceeded, exiting")
+            exit()
+        return
+
+    def finished(self, elapsed):
+        with self.lock:
+            if self.expected is None:
+                self.expected = elapsed
+            else:
+                self.expected = self.expected * 0.7 + elapsed * 0.3
+        if elapsed > 30:
+            print(f"\nNotice: Slow response from DNAC running Command runner, response took {int(elapsed)} seconds)")
+        return
+
+
+# Runs Command Runner jobs as a pipeline of submit, poll, download and collect stages. While job N is being
+# polled, job N+1 is already submitted and the file of job N-1 is downloaded. The number of jobs between
+# submission and collection is bounded by workers. All tasks in flight are checked by a single poller
+# thread following the schedule of dnac.poller. Up to workers files are downloaded and decoded at the same
+# time, the decoded outputs go to a single collect thread that logs them and passes them to the handler,
+# so the handler (the parsers) never runs concurrently.
+class CommandPipeline:
+    def __init__(self, dnac, workers):
+        self.dnac = dnac
+        self.workers = max(1, workers)
+        self.inflight = threading.Semaphore(self.workers)
+        self.pollq = queue.Queue()
+        self.fetchq = queue.Queue()
+        # bounds the decoded outputs waiting for the collect thread
+        self.collectq = queue.Queue(maxsize=self.workers * 8)
+        self.results = {}
+        self.work = None
+        self.handler = None
+        self.error = None
+
+    def submit_stage(self, work):
+        num = 0
+        while True:
+            # the next job is only generated once there is room, so it uses the latest batch size
+            self.inflight.acquire()
+            job = work.next_job()
+            while job is CommandQueue.WAIT and self.error is None:
+                time.sleep(work.wait_time())
+                job = work.next_job()
+            if job is None or self.error is not None:
+                break
+            print(f".", end="")
+            start = time.time()
+            self.pollq.put((num, job, self.dnac.command_submit(job[0], job[1]), start))
+            num = num + 1
+        self.pollq.put(None)
+        return
+
+    def poll_stage(self):
+        poller = self.dnac.poller
+        tasks = []
+        ended = False
+        while not ended or len(tasks) > 0:
+            if self.error is not None:
+                return
+            wait = None
+            if len(tasks) > 0:
+                wait = max(0, tasks[0][0] - time.time())
+            if not ended:
+                try:
+                    task = self.pollq.get(timeout=wait)
+                except queue.Empty:
+                    task = False
+                if task is None:
+                    ended = True
+                    continue
+                elif task is not False:
+                    num, job, taskurl, start = task
+                    heapq.heappush(tasks, (start + poller.delay(0, 0), num, job, taskurl, start, 0))
+                    continue
+            elif wait > 0:
+                time.sleep(wait)
+            while len(tasks) > 0 and tasks[0][0] <= time.time():
+                due, num, job, taskurl, start, checks = heapq.heappop(tasks)
+                fileid = self.dnac.command_check(taskurl)
+                elapsed = time.time() - start
+                if fileid is None:
+                    poller.pending(elapsed, checks)
+                    heapq.heappush(tasks, (time.time() + poller.delay(elapsed, checks + 1), num, job, taskurl,
+                                           start, checks + 1))
+                else:
+                    poller.finished(elapsed)
+                    self.fetchq.put((num, job, fileid, elapsed))
+        return
+
+    # Download threads, the outputs of every device are handed to the collect thread followed by the end of
+    # the job
+    def fetch_stage(self):
+        while True:
+            task = self.fetchq.get()
+            if task is None:
+                return
+            num, job, fileid, duration = task
+            if self.error is not None:
+                continue
+            for device in self.dnac.command_stream(fileid):
+                self.handoff(("device", num, device))
+            self.handoff(("done", num, (job, duration)))
+
+    def handoff(self, item):
+        while self.error is None:
+            try:
+                self.collectq.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+        return
+
+    def collect_stage(self):
+        jobs = {}
+        while True:
+            item = self.collectq.get()
+            if item is None:
+                return
+            kind, num, data = item
+            if self.error is not None:
+                continue
+            ret, size = jobs.setdefault(num, ([], 0))
+            if kind == "device":
+                size = size + self.dnac.collect_device(data, self.work, self.handler)
+                ret.extend(data)
+                jobs[num] = (ret, size)
+            else:
+                del jobs[num]
+                job, duration = data
+                self.results[num] = self.dnac.collect_done(ret, size, duration, job, self.work)
+                self.inflight.release()
+
+    # Wrapper for the stage threads, any error (including exit() calls) is stored and raised again in run
+    def stage(self, target, *args):
+        try:
+            target(*args)
+        except BaseException as err:
+            if self.error is None:
+                self.error = err
+            for i in range(self.workers):
+                self.inflight.release()
+            self.pollq.put(None)
+        return
+
+    def run(self, work, handler=None):
+        self.work = work
+        self.handler = handler
+        submitter = threading.Thread(target=self.stage, args=(self.submit_stage, work), daemon=True)
+        poller = threading.Thread(target=self.stage, args=(self.poll_stage,), daemon=True)
+        fetchers = [threading.Thread(target=self.stage, args=(self.fetch_stage,), daemon=True)
+                    for i in range(self.workers)]
+        collector = threading.Thread(target=self.stage, args=(self.collect_stage,), daemon=True)
+        submitter.start()
+        poller.start()
+        for fetcher in fetchers:
+            fetcher.start()
+        collector.start()
+        submitter.join()
+        poller.join()
+        for fetcher in fetchers:
+            self.fetchq.put(None)
+        for fetcher in fetchers:
+            fetcher.join()
+        while collector.is_alive():
+            try:
+                self.collectq.put(None, timeout=0.5)
+                break
+            except queue.Full:
+                pass
+        collector.join()
+        if self.error is not None:
+            raise self.error
+        ret = []
+        for num in sorted(self.results.keys()):
+            ret.extend(self.results[num])
+        return ret
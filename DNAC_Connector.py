@@ -20,6 +20,219 @@ import http.client
 import json
 import time
 import os
+import shutil
+import tempfile
+import threading
+import email.utils
+import collections
+import atexit
+import Cassette
+import CommandRunner
+import LogWriter
+import ResponseCache
+
+
+# Client side token bucket per API endpoint family to stay below the DNAC API rate limits. A family is not
+# throttled until DNAC refuses one of its requests. A first 429 only pauses the family of the URL that was
+# refused, using Retry-After when DNAC sends it and an exponential backoff when it does not. A second 429
+# within a minute gives the family a learned budget of 80% of the requests sent in the minute before it,
+# never less then floor. Every accepted request adds floor / budget to a learned budget, so it grows back
+# by about floor requests per minute every minute, and every further 429 takes 20% off it. Budgets are
+# requests per minute and can also be set up front through limiter.budgets (-r), these are not adjusted.
+# The bucket allows a burst of 10 seconds worth of requests.
+class RateLimiter:
+    families = [("cli", "/network-device-poller/cli/"), ("task", "/task/"), ("file", "/file/"),
+                ("sda", "/business/sda/"), ("inventory", "/network-device"), ("site", "/site"),
+                ("site", "/membership/")]
+
+    def __init__(self):
+        self.budgets = {}
+        self.learned = {}
+        self.refusals = {}
+        self.sent = {}
+        self.buckets = {}
+        self.backoff = {}
+        self.floor = 30
+        self.lock = threading.Lock()
+
+    def family(self, url):
+        for family, part in self.families:
+            if part in url:
+                return family
+        return "default"
+
+    def acquire(self, url):
+        family = self.family(url)
+        with self.lock:
+            now = time.time()
+            budget = self.budgets.get(family)
+            if budget is None:
+                # not throttled, only the requests of the last minute are counted
+                sent = self.sent.setdefault(family, collections.deque())
+                sent.append(now)
+                while sent[0] < now - 60:
+                    sent.popleft()
+                wait = self.buckets.get(family, (0, now, 0))[2] - now
+            else:
+                rate = budget / 60
+                burst = max(5, rate * 10)
+                tokens, last, blocked = self.buckets.get(family, (burst, now, 0))
+                tokens = min(burst, tokens + max(0, now - last) * rate) - 1
+                wait = 0
+                if tokens < 0:
+                    wait = -tokens / rate
+                wait = max(wait, blocked - now)
+                self.buckets[family] = (tokens, max(now, last), blocked)
+        if wait > 0:
+            time.sleep(wait)
+        return
+
+    def refused(self, url, retry_after):
+        family = self.family(url)
+        with self.lock:
+            delay = self.backoff.get(family, 1) * 2
+            self.backoff[family] = min(delay, 60)
+            if retry_after is not None:
+                if retry_after.isdigit():
+                    delay = int(retry_after)
+                else:
+                    try:
+                        delay = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+                    except (TypeError, ValueError):
+                        pass
+            delay = max(1, min(delay, 60))
+            now = time.time()
+            previous = self.refusals.get(family, 0)
+            self.refusals[family] = now
+            budget = self.budgets.get(family)
+            if budget is None and previous >= now - 60:
+                budget = max(self.floor, int(len(self.sent.pop(family, [])) * 0.8))
+                print(f"Limiting {family} API calls to {budget} per minute")
+            elif family in self.learned.keys():
+                budget = max(self.floor, int(self.learned[family] * 0.8))
+            if budget is not None and (family not in self.budgets.keys() or family in self.learned.keys()):
+                self.budgets[family] = budget
+                self.learned[family] = budget
+            # the family is held back until Retry-After, after that the bucket starts with one request
+            tokens, last, blocked = self.buckets.get(family, (1, now, 0))
+            blocked = max(blocked, now + delay)
+            self.buckets[family] = (min(tokens, 1), blocked, blocked)
+        return delay
+
+    def accepted(self, url):
+        family = self.family(url)
+        if family in self.backoff.keys() or family in self.learned.keys():
+            with self.lock:
+                self.backoff.pop(family, None)
+                if family in self.learned.keys():
+                    self.learned[family] += self.floor / self.learned[family]
+                    self.budgets[family] = int(self.learned[family])
+        return
+
+
+# Pool of keep-alive https connections to DNAC shared by all threads. At most size connections are handed
+# out at the same time, connections that have been idle longer then keepalive seconds are replaced before
+# use since DNAC will likely have closed them.
+class ConnectionPool:
+    def __init__(self, server, size=4, secure=True):
+        self.server = server
+        self.size = size
+        self.secure = secure
+        self.keepalive = 30
+        self.idle = []
+        self.busy = 0
+        self.cond = threading.Condition()
+
+    def new(self):
+        if self.secure is False:
+            return http.client.HTTPConnection(self.server)
+        return http.client.HTTPSConnection(self.server, context=ssl._create_unverified_context())
+
+    # Returns a connection and whether it was used before
+    def get(self):
+        conn = None
+        with self.cond:
+            while len(self.idle) == 0 and self.busy >= self.size:
+                self.cond.wait()
+            self.busy = self.busy + 1
+            if len(self.idle) > 0:
+                conn, last = self.idle.pop()
+        if conn is not None and (conn.sock is None or time.time() - last > self.keepalive):
+            conn.close()
+            conn = None
+        if conn is None:
+            return self.new(), False
+        return conn, True
+
+    def put(self, conn):
+        with self.cond:
+            self.busy = self.busy - 1
+            if len(self.idle) < self.size:
+                self.idle.append((conn, time.time()))
+            else:
+                conn.close()
+            self.cond.notify()
+        return
+
+    def discard(self, conn):
+        conn.close()
+        with self.cond:
+            self.busy = self.busy - 1
+            self.cond.notify()
+        return
+
+    # Sends a request on a pooled connection and returns the connection with the response. A GET failing on
+    # a reused connection (DNAC may have closed it in the meantime) is sent once more on a fresh connection
+    # before the error is passed on. Other requests are not repeated, a POST that timed out may well have
+    # reached DNAC and sending it again could for instance start a Command Runner job twice.
+    def send(self, method, url, body, headers):
+        conn, reused = self.get()
+        try:
+            conn.request(method, url, body, headers=headers)
+            return conn, conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            if reused is False or method != "GET":
+                self.discard(conn)
+                raise
+            conn.close()
+        except BaseException:
+            self.discard(conn)
+            raise
+        conn = self.new()
+        try:
+            conn.request(method, url, body, headers=headers)
+            return conn, conn.getresponse()
+        except BaseException:
+            self.discard(conn)
+            raise
+
+    # Sends a request on a pooled connection and returns the response with its body
+    def request(self, method, url, body, headers):
+        conn, res = self.send(method, url, body, headers)
+        try:
+            content = res.read()
+        except BaseException:
+            self.discard(conn)
+            raise
+        self.put(conn)
+        return res, content
+
+    # Like request, but yields the response followed by the body in chunks of up to chunk bytes. The
+    # connection is only returned to the pool once the body has been read completely.
+    def stream(self, method, url, body, headers, chunk=64 * 1024):
+        conn, res = self.send(method, url, body, headers)
+        try:
+            yield res
+            while True:
+                data = res.read(chunk)
+                if not data:
+                    break
+                yield data
+        except BaseException:
+            self.discard(conn)
+            raise
+        self.put(conn)
+        return
 
 
 class DnacCon:
@@ -29,7 +242,16 @@ class DnacCon:
     token = None
     logdir = None
 
-    def __init__(self, server, user, pword, directory):
+    # With record the HTTP exchanges are written to that cassette file, with replay they are answered from
+    # it instead of DNAC (see Cassette.py), at full speed or with realtime at the recorded timing.
+    def __init__(self, server, user, pword, directory, record=None, replay=None, realtime=False):
+        secure = True
+        if server.startswith("http://"):
+            # plain http is only meant for a local test server like MockDnac
+            server = server[len("http://"):]
+            secure = False
+        elif server.startswith("https://"):
+            server = server[len("https://"):]
         self.DNAC = server
         self.username = user
         self.password = pword
@@ -39,23 +261,60 @@ class DnacCon:
         self.wlc = {}
         self.devices = {}
         self.debug = False
-        self.crunnerretry = 0
-        self.conn = None
+        self.pool = ConnectionPool(server, secure=secure)
+        # number of Command Runner jobs allowed in flight, 1 runs jobs one after the other
+        self.workers = 1
+        self.batcher = CommandRunner.CommandBatcher()
+        self.poller = CommandRunner.TaskPoller()
+        self.limiter = RateLimiter()
+        self.checker = CommandRunner.OutputChecker()
+        self.cache = None
+        self.configs = None
+        self.parsed = None
+        self.logger = None
+        # reachability of the devices is refreshed in the background once older then reach_ttl seconds
+        self.reach_ttl = 60
+        self.reach_time = 0
+        self.reach_thread = None
+        self.reach_lock = threading.Lock()
+        # Command Runner jobs to cut, in order, instead of following the batcher (replay only)
+        self.jobs = None
+        if replay is not None:
+            self.pool = Cassette.Player(replay, realtime)
+            self.jobs = self.pool.jobs
+            if realtime is False:
+                # no pacing of the task polls, the recorded responses are available right away
+                self.poller.first = 0
+        elif record is not None:
+            self.pool = Cassette.Recorder(self.pool, record)
 
         time.localtime()
         if server != "non-interactive":
             self.get_token()
             self.logdir = f"log{time.localtime().tm_mon}{time.localtime().tm_mday}_{time.localtime().tm_hour}" \
                           f"{time.localtime().tm_min}"
-            if directory is not None:
-                self.logdir = os.path.join(directory, self.logdir)
-            else:
-                self.logdir = os.path.join(os.getcwd(), self.logdir)
+            if directory is None:
+                directory = os.getcwd()
+            self.logdir = os.path.abspath(os.path.join(directory, self.logdir))
+            # responses are cached next to the log directories so they survive a restart
+            cachedir = os.path.join(directory, "dnac_cache")
+            # outputs repeated across sessions are logged once in the output store
+            store = os.path.join(cachedir, "outputs")
+            if record is not None or replay is not None:
+                # a recorded or replayed session starts without cache so both send the same requests, its
+                # logs do not refer to the temporary cache
+                cachedir = tempfile.mkdtemp(prefix="sda_cassette")
+                atexit.register(shutil.rmtree, cachedir, True)
+                store = None
+            self.cache = ResponseCache.ResponseCache(cachedir, server)
+            self.configs = ResponseCache.ConfigCache(os.path.join(cachedir, "configs"))
+            self.parsed = ResponseCache.ParseCache(os.path.join(cachedir, "parsed"))
             if os.path.exists(self.logdir):
                 # directory already exists. appending outputs
                 pass
             else:
                 os.makedirs(self.logdir)
+            self.logger = LogWriter.LogWriter(self.logdir, store=store)
             print(f"Storing outputs in directory {self.logdir}")
         else:
             self.fabric = "Bundled"
@@ -70,28 +329,20 @@ class DnacCon:
         authraw = self.username + ":" + self.password
         auth64 = base64.b64encode(authraw.encode("utf-8")).decode("utf-8")
 
-        try:
-            self.conn = http.client.HTTPSConnection(self.DNAC, context=ssl._create_unverified_context())
-        except:
-            print(f"error connecting to server {self.DNAC}")
-            exit()
-
         headers = {
             'content-type': "application/json",
             'authorization': f"Basic {auth64}"
         }
         try:
             # print(headers)
-            self.conn.request("POST", f"https://{self.DNAC}/api/system/v1/auth/token", headers=headers)
+            res, content = self.pool.request("POST", f"https://{self.DNAC}/api/system/v1/auth/token", None, headers)
             # print (headers)
-        except:
+        except Exception:
             print(f"Error connecting to server {self.DNAC}, exiting")
             exit()
 
-        res = self.conn.getresponse()
-
         if res.status == 200:
-            data = json.loads(res.read())
+            data = json.loads(content)
             self.token = data["Token"]
             print(f"Connection established to {self.DNAC}")
         elif res.status == 401:
@@ -110,144 +361,229 @@ class DnacCon:
         return
 
     def geturl(self, url):
-        headers = {
-            'content-type': "application/json",
-            'x-auth-token': self.token
-        }
         realurl = f"https://{self.DNAC}{url}"
+        if self.cache is not None:
+            data = self.cache.get(url)
+            if data is not None:
+                if self.debug is True:
+                    print(f"Debug: Using cached response for {realurl}")
+                return data
         if self.debug is True:
             print(f"Debug: Calling URL {realurl}")
-        try:
-            # conn = http.client.HTTPSConnection(self.DNAC, context=ssl._create_unverified_context())
-            self.conn.request("GET", realurl, headers=headers)
-            # print (realurl)
-        except:
-            print(f"Error connecting to server {self.DNAC}, exiting")
-            exit()
         while True:
+            headers = {
+                'content-type': "application/json",
+                'x-auth-token': self.token
+            }
+            self.limiter.acquire(url)
             try:
-                res = self.conn.getresponse()
-            except:
-                self.conn = http.client.HTTPSConnection(self.DNAC, context=ssl._create_unverified_context())
-                self.conn.request("GET", realurl, headers=headers)
-                print(f"Reopening https connection")
-            else:
-                # print (res.status)
-                if res.status == 404:
-                    ret = (res.read())
-                    print(
-                        f"Internal Error encountered {ret} (bapi errors often resolved by disabling/enabling the RESTAPI bundle under platform/manager")
-                if res.status == 401:
-                    ret = (res.read())
-                    self.get_token()
-                elif res.status == 429:
-                    print(f"Exceeded limit for API calls calling {url}, pausing for 60 seconds")
-                    time.sleep(60)
-                    print(f"Reopening https connection to {self.DNAC} after pausing")
-                    self.conn = http.client.HTTPSConnection(self.DNAC, context=ssl._create_unverified_context())
-                    self.conn.request("GET", realurl, headers=headers)
-                elif res.status > 299:
-                    print(f"{res.status} error encountered when trying to get {url}")
-                    resp = res.read()
-                    if type(resp) == bytes:
-                        resp=resp.decode('utf-8').strip("{}")
-                    print(f"Error response: {resp}")
-                    exit(0)
-                else:
-                    break
-        content = res.read()
+                res, content = self.pool.request("GET", realurl, None, headers)
+                # print (realurl)
+            except Exception:
+                print(f"Error connecting to server {self.DNAC}, exiting")
+                exit()
+            # print (res.status)
+            if self.response_ok(url, res, content):
+                break
+        data = json.loads(content)
         if self.debug is True:
-            print(f"Debug: Calling URL {json.loads(content)}")
-        return json.loads(content)
+            print(f"Debug: Calling URL {data}")
+        if self.cache is not None:
+            self.cache.put(url, data)
+        return data
+
+    # Handles the status of a GET response, returns False when the request has to be sent again
+    def response_ok(self, url, res, content):
+        if res.status == 404:
+            print(
+                f"Internal Error encountered {content} (bapi errors often resolved by disabling/enabling the RESTAPI bundle under platform/manager")
+        if res.status == 401:
+            self.get_token()
+        elif res.status == 429:
+            self.refused_cli(url)
+            delay = self.limiter.refused(url, res.getheader("Retry-After"))
+            print(f"Exceeded limit for API calls calling {url}, retrying in {int(delay)} seconds")
+        elif res.status > 299:
+            print(f"{res.status} error encountered when trying to get {url}")
+            resp = content
+            if type(resp) == bytes:
+                resp=resp.decode('utf-8').strip("{}")
+            print(f"Error response: {resp}")
+            exit(0)
+        else:
+            self.limiter.accepted(url)
+            return True
+        return False
+
+    # Smaller Command Runner jobs only help when DNAC refused a Command Runner call, a refused inventory or
+    # site lookup leaves the job size alone
+    def refused_cli(self, url):
+        if self.limiter.family(url) in ("cli", "task", "file"):
+            self.batcher.shrink()
+        return
+
+    # GETs a url returning a json list and yields the list elements as they are decoded from the response,
+    # without keeping the whole response in memory. Responses are never cached.
+    def geturl_stream(self, url):
+        realurl = f"https://{self.DNAC}{url}"
+        if self.debug is True:
+            print(f"Debug: Streaming URL {realurl}")
+        while True:
+            headers = {
+                'content-type': "application/json",
+                'x-auth-token': self.token
+            }
+            self.limiter.acquire(url)
+            try:
+                body = self.pool.stream("GET", realurl, None, headers)
+                res = next(body)
+            except Exception:
+                print(f"Error connecting to server {self.DNAC}, exiting")
+                exit()
+            if res.status < 300:
+                self.limiter.accepted(url)
+                break
+            self.response_ok(url, res, b"".join(body))
+        for item in CommandRunner.stream_items(body):
+            yield item
+        return
 
     def post(self, url, payload):
         # print (f"executing {url} with {payload}")
-        header = {
-            'content-type': "application/json",
-            'X-Auth-Token': self.token
-        }
         jpay = json.dumps(payload)
-        try:
-            # conn = http.client.HTTPSConnection(self.DNAC, context=ssl._create_unverified_context())
-            self.conn.request("POST", f"https://{self.DNAC}{url}", jpay, headers=header)
-        except:
-            print(f"Error connecting to server {self.DNAC},  exiting")
-            exit()
-        res = self.conn.getresponse()
-        return json.loads(res.read())
+        while True:
+            header = {
+                'content-type': "application/json",
+                'X-Auth-Token': self.token
+            }
+            self.limiter.acquire(url)
+            try:
+                res, content = self.pool.request("POST", f"https://{self.DNAC}{url}", jpay, header)
+            except Exception:
+                print(f"Error connecting to server {self.DNAC},  exiting")
+                exit()
+            if res.status != 429:
+                break
+            self.refused_cli(url)
+            delay = self.limiter.refused(url, res.getheader("Retry-After"))
+            print(f"Exceeded limit for API calls calling {url}, retrying in {int(delay)} seconds")
+        self.limiter.accepted(url)
+        return json.loads(content)
 
-    def command_run_batch(self, commands, devs):
-        i = 0
+    # Command Runner stage 1: submit the read-request and return the task url to poll
+    def command_submit(self, commands, devs):
         payload = {'commands': commands, 'deviceUuids': devs}
-        ret = []
         # print (payload)
-        self.conn = http.client.HTTPSConnection(self.DNAC, context=ssl._create_unverified_context())
         resp = self.post("/dna/intent/api/v1/network-device-poller/cli/read-request", payload)
         if "response" not in resp.keys():
             print(resp)
         if 'errorCode' in resp["response"].keys():
             print(f"Encountered unexpected error: {resp['response']['errorCode']} : {resp['response']['message']}")
             exit()
-        tresp = self.geturl(resp["response"]["url"])
-        while "endTime" not in tresp["response"].keys():
-            i = i + 1
-            time.sleep(1)
-            if i % 5 == 0:
-                print(f"o", end="")
-            tresp = self.geturl(resp["response"]["url"])
-            if i > 300:
-                print(f"Timeout exceeded, exiting")
-                exit()
-        if i > 30:
-            print(f"\nNotice: Slow response from DNAC running Command runner, response took {i} seconds)")
-        fileId = json.loads(tresp["response"]["progress"])
-        fresp = self.geturl(f"/dna/intent/api/v1/file/{fileId['fileId']}")
-        # print (fresp)
-        for single_resp in fresp:
+        return resp["response"]["url"]
+
+    # Checks a Command Runner task once, returns the fileId of the results or None while it is still running
+    def command_check(self, taskurl):
+        tresp = self.geturl(taskurl)
+        if "endTime" not in tresp["response"].keys():
+            return None
+        return json.loads(tresp["response"]["progress"])["fileId"]
+
+    # Command Runner stage 2: poll the task until it has finished and return the fileId of the results
+    def command_poll(self, taskurl, start):
+        checks = 0
+        while True:
+            time.sleep(self.poller.delay(time.time() - start, checks))
+            fileid = self.command_check(taskurl)
+            if fileid is not None:
+                break
+            self.poller.pending(time.time() - start, checks)
+            checks = checks + 1
+        self.poller.finished(time.time() - start)
+        return fileid
+
+    # Command Runner stage 3: download the result file and yield the outputs of one device at a time as
+    # [{host, output}]. Every output also has the command and its state: complete, truncated, failed (worth
+    # retrying) or rejected.
+    def command_stream(self, fileid):
+        for single_resp in self.geturl_stream(f"/dna/intent/api/v1/file/{fileid}"):
+            ret = []
             res_name = self.topo["devices"][single_resp['deviceUuid']]
-            for responses in single_resp['commandResponses']:
-                if responses == "SUCCESS":
-                    for command in single_resp['commandResponses']['SUCCESS']:
-                        output = single_resp['commandResponses']['SUCCESS'][command]
-                        ret.append({"host": res_name, "output": output})
-                else:
-                    for command in single_resp['commandResponses']['FAILURE']:
-                        for failed_cli in single_resp['commandResponses']["FAILURE"].keys():
-                            if self.debug is True:
-                                print(f"Failed command : {failed_cli}")
-                        # print(single_resp['commandResponses']["FAILURE"])
-                    pass
+            outputs = single_resp['commandResponses'].get('SUCCESS', {})
+            prompted = self.checker.prompted(outputs)
+            for command in outputs:
+                output = outputs[command]
+                state = self.checker.state(res_name, command, output, prompted)
+                if state != "complete" and self.debug is True:
+                    print(f"Incomplete output for command : {command}")
+                ret.append({"host": res_name, "output": output, "command": command, "state": state})
+            for responses in ("FAILURE", "BLACKLISTED"):
+                failures = single_resp['commandResponses'].get(responses, {})
+                for failed_cli in failures.keys():
+                    if self.debug is True:
+                        print(f"Failed command : {failed_cli}")
+                    reason = str(failures[failed_cli])
+                    state = "rejected"
+                    if responses == "FAILURE" and self.checker.transient(reason):
+                        state = "failed"
+                    ret.append({"host": res_name, "output": reason, "command": failed_cli, "state": state})
+            yield ret
+        return
+
+    def command_fetch(self, fileid):
+        ret = []
+        for device in self.command_stream(fileid):
+            ret.extend(device)
+        return ret
+
+    # Command Runner stage 4: queue the complete (and incomplete) outputs for the per host log files, the
+    # position of every output in the log is kept in its "log" entry as (filename, offset, length)
+    def command_log(self, ret):
         combined = {}
-        olddir = os.getcwd()
-        os.chdir(self.logdir)
         for res in ret:
+            if res.get("state", "complete") not in ("complete", "incomplete"):
+                continue
             if res["host"] in combined.keys():
-                combined[res["host"]].append(res["output"])
+                combined[res["host"]].append(res)
             else:
-                combined[res["host"]] = [res["output"]]
+                combined[res["host"]] = [res]
         for outhosts in combined.keys():
-            fd = open(f"{outhosts}.txt", "a+")
-            for outs in combined[outhosts]:
-                fd.write(outs)
-            fd.close()
-        os.chdir(olddir)
-        return ret
+            self.logger.write(outhosts, combined[outhosts])
+        return
 
-    def command_run_dev_batch(self, commands, devs):
-        tret = []
-        i = 0
-        t = 0
-        cmds = []
-        for cmd in commands:
-            cmds.append(cmd)
-            i = i + 1
-            t = t + 1
-            if len(cmds) > 3 or i == len(commands):
-                print(f".", end="")
-                tret.extend(self.command_run_batch(cmds, devs))
-                t = 0
-                cmds = []
-        return tret
+    # Downloads and logs the results of a job and returns the outputs accepted by the work queue. With a
+    # handler every complete output is passed to it as soon as its device is decoded and the returned
+    # outputs only keep the position in the log, see command_output.
+    def command_collect(self, fileid, duration, job, work, handler):
+        ret = []
+        size = 0
+        for device in self.command_stream(fileid):
+            size = size + self.collect_device(device, work, handler)
+            ret.extend(device)
+        return self.collect_done(ret, size, duration, job, work)
+
+    # Logs the outputs of one device and passes them to the handler, returns the size of the outputs
+    def collect_device(self, device, work, handler):
+        size = 0
+        work.settle(device)
+        self.command_log(device)
+        for res in device:
+            size = size + len(res["output"])
+            if handler is not None and res["state"] != "rejected":
+                if res["state"] in ("complete", "incomplete"):
+                    handler(res)
+                del res["output"]
+        return size
+
+    def collect_done(self, ret, size, duration, job, work):
+        self.batcher.record(duration, size)
+        return work.complete(job, ret)
+
+    # Returns the output of a command_run result, reading it back from the log when it is not kept
+    def command_output(self, res):
+        if "output" in res.keys():
+            return res["output"]
+        return self.logger.read(res["log"])
 
     def update_reachable(self):
         tre = self.geturl("/dna/intent/api/v1/network-device?reachabilityStatus=Unreachable")
@@ -255,57 +591,63 @@ class DnacCon:
         unreach_ids = set()
         for un_devs in response:
             unreach_ids.add(un_devs['id'])
-        for device in self.topo['reach'].keys():
-            dname = self.topo['devices'][device]
-            if device in unreach_ids and device in self.topo['reach'].keys():
+        for device in list(self.topo['reach'].keys()):
+            if device in unreach_ids:
                 self.topo['reach'][device] = "Unreachable"
             else:
                 self.topo['reach'][device] = "Reachable"
+        self.reach_time = time.time()
         return
 
-    def command_run(self, commands, devs):
-        ttret = []
-        if self.crunnerretry > 10:
-            return None
+    # Starts a background refresh of the reachability when it is outdated. Callers continue with the
+    # current view in topo['reach'] and never wait for the refresh.
+    def refresh_reachable(self):
+        with self.reach_lock:
+            if time.time() - self.reach_time < self.reach_ttl:
+                return
+            if self.reach_thread is not None and self.reach_thread.is_alive():
+                return
+            self.reach_thread = threading.Thread(target=self.update_reachable, daemon=True)
+            self.reach_thread.start()
+        return
+
+    # Runs the commands on the devices and returns the outputs as [{host, output, command}]. With a handler
+    # each output is passed to handler(output) as soon as it is received instead of being kept in memory.
+    def command_run(self, commands, devs, handler=None):
         print(f"Requesting {len(commands)} commands on {len(devs)} device(s) via {self.DNAC}")
-        self.update_reachable()
+        self.refresh_reachable()
         tret = []
-        ttret = []
-        i = 0
-        t = 0
         devices = []
-        devicenames = set()
         for dev in devs:
             if (self.topo['reach'][dev]) != "Unreachable":
                 devices.append(dev)
-                devicenames.add(self.topo['devices'][dev])
-                i = i + 1
-                t = t + 1
-                if len(devices) > 4 or i == len(devs):
-                    tret.extend(self.command_run_dev_batch(commands, devices))
-                    t = 0
-                    devices = []
             else:
                 print(f"skipping device {self.topo['devices'][dev]} in state {self.topo['reach'][dev]}")
-        sucdevs = set()
-        for tre in tret:
-            succeshost = tre.get('host')
-            if succeshost not in sucdevs and not None:
-                sucdevs.add(succeshost)
-        sucset = devicenames.difference(sucdevs)
-        if len(sucset) > 0:
-            print(f"Command runner failed on {len(sucset)} devices {sucset} retrying")
-            retrydevs = []
-            for devs in sucset:
-                self.crunnerretry = self.crunnerretry + 1
-                retrydevs.append(self.topo['hostnames'][devs])
-            resp = self.command_run(commands, retrydevs)
-            if resp is not None:
-                tret.extend(resp)
-        self.crunnerretry = self.crunnerretry - 1
-        if self.crunnerretry < 1:
-            print("\nCompleted")
-            self.crunnerretry = 0
-        if tret is None:
-            tret["response"] = {}
+        if len(devices) == 0 or len(commands) == 0:
+            print("No reachable devices to run the commands on")
+            return tret
+        # job sizes are decided by the batcher as the jobs are taken from the queue, commands without
+        # output are retried per device through the same queue
+        work = CommandRunner.CommandQueue(self, commands, devices)
+        if self.workers > 1:
+            tret.extend(CommandRunner.CommandPipeline(self, self.workers).run(work, handler))
+        else:
+            while True:
+                job = work.next_job()
+                if job is None:
+                    break
+                if job is CommandRunner.CommandQueue.WAIT:
+                    time.sleep(work.wait_time())
+                    continue
+                print(f".", end="")
+                start = time.time()
+                taskurl = self.command_submit(job[0], job[1])
+                fileid = self.command_poll(taskurl, start)
+                tret.extend(self.command_collect(fileid, time.time() - start, job, work, handler))
+        if len(work.failed) > 0:
+            print(f"\nCommand runner failed on {len(work.failed)} devices {set(work.failed.keys())}")
+        if len(work.incomplete) > 0:
+            print(f"\nCommand runner returned incomplete output on {len(work.incomplete)} devices "
+                  f"{set(work.incomplete.keys())}")
+        print("\nCompleted")
         return tret
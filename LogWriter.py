@@ -0,0 +1,288 @@
+"""Copyright (c) 2021 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+import atexit
+import gzip
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+
+
+# Writes the command outputs to the per host log files from a background thread. The files are kept open
+# (at most max_open at a time) and flushed every interval seconds. With compress set every output is
+# written to {host}.txt.gz as a gzip member of its own, so the log is still a valid gzip file and any
+# output can be decompressed without the ones before it. Next to every log an index file (log name +
+# ".idx") has one json line per output with the command, time, offset, length and hash of the output,
+# outputs Command Runner never returned in full are marked with "incomplete". An output identical to one
+# already in the log is not written again, its index entry refers to the earlier copy and is marked with
+# "ref".
+# Every session writes to a new log directory, with store set outputs are also deduplicated across
+# sessions. The hashes of the outputs logged are kept in the seen file of the store directory (at most
+# max_seen), an output that was logged in an earlier session is written once to the store as {hash}.txt
+# (or .txt.gz) and the index entries of the logs refer to that file with "file", relative to the log.
+class LogWriter:
+    def __init__(self, logdir, compress=False, store=None):
+        self.logdir = os.path.abspath(logdir)
+        self.compress = compress
+        self.store = None
+        if store is not None:
+            self.store = os.path.abspath(store)
+        self.max_seen = 100000
+        self.seen = None
+        self.seenfd = None
+        self.interval = 5
+        self.max_open = 256
+        self.handles = {}
+        self.hashes = {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=16)
+        self.thread = None
+        self.error = None
+        atexit.register(self.close)
+
+    def filename(self, host):
+        if self.compress is True:
+            return os.path.join(self.logdir, f"{host}.txt.gz")
+        return os.path.join(self.logdir, f"{host}.txt")
+
+    # Queues the outputs of one host. Every output gets its index entry as "log", the offset and length
+    # are filled in once the output has been written.
+    def write(self, host, outputs):
+        if self.error is not None:
+            raise self.error
+        filename = self.filename(host)
+        chunks = []
+        for res in outputs:
+            if "hash" not in res.keys():
+                res["hash"] = output_hash(host, res.get("command"), res["output"])
+            entry = {"command": res.get("command"), "time": time.time(), "offset": None, "length": None,
+                     "hash": res["hash"], "file": filename}
+            if res.get("state") == "incomplete":
+                entry["incomplete"] = True
+            res["log"] = entry
+            chunks.append((entry, res["output"].encode("utf-8")))
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.queue.put((filename, chunks))
+        return
+
+    def handle(self, filename):
+        fds = self.handles.pop(filename, None)
+        if fds is None:
+            if len(self.handles) >= self.max_open:
+                oldest = next(iter(self.handles))
+                for fd in self.handles.pop(oldest):
+                    fd.close()
+            fds = (open(filename, "ab", buffering=256 * 1024), open(f"{filename}.idx", "a"))
+            if filename not in self.hashes.keys():
+                self.hashes[filename] = {}
+                for entry in read_index(filename) or []:
+                    if entry.get("hash") is not None:
+                        self.hashes[filename][entry["hash"]] = (entry.get("file"), entry["offset"],
+                                                                entry["length"])
+        # most recently used handles are kept at the end
+        self.handles[filename] = fds
+        return fds
+
+    # Returns True when an output was logged before (in any session), otherwise remembers its hash
+    def sighted(self, chash):
+        if self.seen is None:
+            os.makedirs(self.store, exist_ok=True)
+            seenfile = os.path.join(self.store, "seen.txt")
+            seen = []
+            try:
+                with open(seenfile, "r") as fd:
+                    seen = fd.read().split()
+            except OSError:
+                pass
+            if len(seen) > self.max_seen:
+                seen = seen[-(self.max_seen // 2):]
+                with open(seenfile, "w") as fd:
+                    fd.write("".join([f"{chash}\n" for chash in seen]))
+            self.seen = set(seen)
+            self.seenfd = open(seenfile, "a")
+        if chash in self.seen:
+            return True
+        self.seen.add(chash)
+        self.seenfd.write(f"{chash}\n")
+        return False
+
+    # Returns the store file of an output logged in an earlier session, the output is written to the store
+    # the first time. None when the output was not logged before.
+    def stored(self, chash, data):
+        if self.sighted(chash) is False:
+            return None
+        for name in (f"{chash}.txt", f"{chash}.txt.gz"):
+            storename = os.path.join(self.store, name)
+            if os.path.exists(storename):
+                return storename
+        storename = os.path.join(self.store, f"{chash}.txt")
+        if self.compress is True:
+            storename = f"{storename}.gz"
+            data = gzip.compress(data)
+        tmpname = f"{storename}.{threading.get_ident()}"
+        with open(tmpname, "wb") as fd:
+            fd.write(data)
+        os.replace(tmpname, storename)
+        return storename
+
+    # Writer thread, the file handles are only used here. Besides outputs the queue carries ("flush", event)
+    # and ("close", event) requests, the event is set once they are done.
+    def run(self):
+        last = time.time()
+        while True:
+            try:
+                filename, item = self.queue.get(timeout=self.interval)
+            except queue.Empty:
+                filename, item = None, None
+            try:
+                if filename in ("flush", "close"):
+                    for fds in self.handles.values():
+                        for fd in fds:
+                            fd.flush()
+                            if filename == "close":
+                                fd.close()
+                    if self.seenfd is not None:
+                        self.seenfd.flush()
+                    if filename == "close":
+                        self.handles = {}
+                        if self.seenfd is not None:
+                            self.seenfd.close()
+                            self.seen = None
+                            self.seenfd = None
+                    last = time.time()
+                elif filename is not None:
+                    fd, idx = self.handle(filename)
+                    hashes = self.hashes[filename]
+                    for entry, data in item:
+                        record = {"command": entry["command"], "time": entry["time"], "hash": entry["hash"]}
+                        if entry.get("incomplete") is True:
+                            record["incomplete"] = True
+                        storename = None
+                        if entry["hash"] in hashes.keys():
+                            storename, entry["offset"], entry["length"] = hashes[entry["hash"]]
+                            record["ref"] = True
+                        else:
+                            if self.store is not None:
+                                storename = self.stored(entry["hash"], data)
+                            if storename is not None:
+                                storename = os.path.relpath(storename, self.logdir)
+                                entry["offset"] = 0
+                                entry["length"] = os.path.getsize(os.path.join(self.logdir, storename))
+                                record["ref"] = True
+                            else:
+                                if filename.endswith(".gz"):
+                                    data = gzip.compress(data)
+                                entry["offset"] = fd.tell()
+                                entry["length"] = len(data)
+                                fd.write(data)
+                            hashes[entry["hash"]] = (storename, entry["offset"], entry["length"])
+                        if storename is not None:
+                            record["file"] = storename
+                            entry["file"] = os.path.join(self.logdir, storename)
+                        record["offset"] = entry["offset"]
+                        record["length"] = entry["length"]
+                        idx.write(json.dumps(record) + "\n")
+                if time.time() - last >= self.interval:
+                    for fds in self.handles.values():
+                        for fd in fds:
+                            fd.flush()
+                    if self.seenfd is not None:
+                        self.seenfd.flush()
+                    last = time.time()
+            except BaseException as err:
+                self.error = err
+            if filename in ("flush", "close"):
+                item.set()
+
+    def request(self, action):
+        if self.thread is None:
+            return
+        done = threading.Event()
+        self.queue.put((action, done))
+        done.wait()
+        if self.error is not None:
+            raise self.error
+        return
+
+    # Waits until everything queued so far is written to the log files
+    def flush(self):
+        self.request("flush")
+        return
+
+    def close(self):
+        self.request("close")
+        return
+
+    # Returns an output from its index entry
+    def read(self, entry):
+        self.flush()
+        return read_output(entry["file"], entry)
+
+
+# Content address of an output, the same output of the same command on the same host has the same hash
+def output_hash(host, command, output):
+    return hashlib.sha256(f"{host}\0{command}\0{output}".encode("utf-8")).hexdigest()
+
+
+# Returns the index entries of a log file in the order the outputs were written, None without index
+def read_index(filename):
+    try:
+        fd = open(f"{filename}.idx", "r")
+    except OSError:
+        return None
+    entries = []
+    with fd:
+        for line in fd:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # last line of a log that was not closed properly
+                break
+    return entries
+
+
+# Reads one output from a log file using its index entry, entries with "file" refer to the output store
+def read_output(filename, entry):
+    if entry.get("file") is not None:
+        filename = os.path.join(os.path.dirname(filename), entry["file"])
+    with open(filename, "rb") as fd:
+        fd.seek(entry["offset"])
+        data = fd.read(entry["length"])
+    if filename.endswith(".gz"):
+        data = gzip.decompress(data)
+    return data.decode("utf-8")
+
+
+# Returns the most recently logged output of command on host found in the log directories, or None
+def last_output(directories, host, command):
+    found = None
+    for directory in directories:
+        for filename in (os.path.join(directory, f"{host}.txt"), os.path.join(directory, f"{host}.txt.gz")):
+            entries = read_index(filename)
+            if entries is None:
+                continue
+            for entry in entries:
+                if str(entry["command"]).strip() == command.strip() and (found is None or entry["time"] >= found[1]["time"]):
+                    found = (filename, entry)
+    if found is None:
+        return None
+    return read_output(found[0], found[1])
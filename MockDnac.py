@@ -0,0 +1,433 @@
+"""Copyright (c) 2021 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+import sys
+import getopt
+import json
+import math
+import re
+import ssl
+import threading
+import time
+import http.server
+import urllib.parse
+
+# Local stand in for DNAC serving the API calls SDA Digger uses on a synthetic fabric, to benchmark and
+# try out the tool without a DNAC. Start it with python MockDnac.py -n <devices> and connect SDA Digger
+# with -d http://127.0.0.1:<port> (or https:// when a certificate is given with -c/-k).
+#
+# The fabric has 2 CP/border nodes and devices - 2 edges, each edge has endpoints endpoints in instance
+# 4097 (IPv4) and 8188 (ethernet) and mapcache remote entries in its map-cache. Every request is delayed
+# by latency seconds, Command Runner jobs take job_duration seconds plus job_device seconds per device.
+# With cli_rate or api_rate set, read-requests or all requests above that number per minute get a 429.
+# GET /mock/stats returns the number of API calls per endpoint family, POST /mock/reset clears them.
+
+families = [("token", "/auth/token"), ("cli", "/network-device-poller/"), ("task", "/task/"), ("file", "/file/"),
+            ("fabric-site", "/business/sda/fabric-site"), ("sda-device", "/business/sda/device"),
+            ("membership", "/membership/"), ("config", "/config"), ("network-device", "/network-device"),
+            ("site", "/site")]
+
+
+class MockFabric:
+    def __init__(self, devices=50, endpoints=10, mapcache=50, unreachable=0):
+        self.count = max(3, devices)
+        self.endpoints = endpoints
+        self.mapcache = mapcache
+        self.devices = []
+        self.byid = {}
+        self.byip = {}
+        for k in range(self.count):
+            rloc = f"192.168.{k // 250}.{k % 250 + 1}"
+            dev = {"id": f"00000000-0000-4000-8000-{k:012d}", "hostname": f"edge{k}", "managementIpAddress": rloc,
+                   "softwareVersion": "17.3.4", "reachabilityStatus": "Reachable", "lastUpdateTime": 1600000000000,
+                   "family": "Switches and Hubs", "platformId": "C9300-48U", "index": k}
+            if k < 2:
+                dev["hostname"] = f"cpborder{k}"
+                dev["roles"] = ["MAPSERVER", "BORDERNODE"]
+            else:
+                dev["roles"] = ["EDGENODE"]
+                if k - 2 < unreachable:
+                    dev["reachabilityStatus"] = "Unreachable"
+            self.devices.append(dev)
+            self.byid[dev["id"]] = dev
+            self.byip[rloc] = dev
+        self.edges = [dev for dev in self.devices if "EDGENODE" in dev["roles"]]
+        self.cps = [dev for dev in self.devices if "MAPSERVER" in dev["roles"]]
+        self.buildings = max(1, self.count // 100)
+        self.sites = [{"id": "site-global", "siteNameHierarchy": "Global"},
+                      {"id": "site-area", "siteNameHierarchy": "Global/Area", "parentId": "site-global"}]
+        for b in range(self.buildings):
+            self.sites.append({"id": f"site-b{b}", "siteNameHierarchy": f"Global/Area/Building{b}",
+                               "parentId": "site-area"})
+            for f in range(3):
+                self.sites.append({"id": f"site-b{b}-f{f}", "siteNameHierarchy": f"Global/Area/Building{b}/Floor{f}",
+                                   "parentId": f"site-b{b}"})
+        self.fabric_site = "Global/Area/Building0"
+
+    # Endpoint j of an edge as (ip, mac)
+    def endpoint(self, dev, j):
+        g = (dev["index"] - 2) * self.endpoints + j + 2
+        return f"10.{16 + g // 65536}.{(g // 256) % 256}.{g % 256}", f"0000.{dev['index']:04x}.{j:04x}"
+
+    # Remote endpoint m in the map-cache of an edge as (ip, mac, rloc)
+    def remote(self, dev, m):
+        total = len(self.edges) * self.endpoints
+        g = ((dev["index"] - 2) * self.endpoints + 7919 * (m + 1)) % total
+        owner = self.edges[g // self.endpoints]
+        ip, mac = self.endpoint(owner, g % self.endpoints)
+        return ip, mac, owner["managementIpAddress"]
+
+    def config(self, dev):
+        lines = ["!", "hostname " + dev["hostname"], "!", "system mtu 9100", "!", "interface Loopback0",
+                 f" ip address {dev['managementIpAddress']} 255.255.255.255", "!"]
+        if "EDGENODE" in dev["roles"]:
+            lines += ["interface Vlan1021", " mac-address 0000.0c9f.f45c", " vrf forwarding Campus",
+                      " ip address 10.16.0.1 255.240.0.0", " lisp mobility Campus_IPV4", "!"]
+        lines += ["router lisp", " locator-set rloc_x", f"  IPv4-interface Loopback0 priority 10 weight 10", " !",
+                  " instance-id 4097", "  service ipv4", "   eid-table vrf Campus"]
+        if "EDGENODE" in dev["roles"]:
+            lines += ["   database-mapping 10.16.0.0/12 locator-set rloc_x"]
+        else:
+            lines += ["   route-import database bgp 65001 route-map permit-all locator-set rloc_x", "   proxy-etr"]
+        lines += ["  exit-service-ipv4", " exit-instance-id", " !"]
+        if "EDGENODE" in dev["roles"]:
+            lines += [" instance-id 8188", "  remote-rloc-probe on-route-change", "  service ethernet",
+                      "   eid-table vlan 1021", "   broadcast-underlay 239.0.17.1",
+                      "   database-mapping mac locator-set rloc_x", "  exit-service-ethernet", " exit-instance-id",
+                      " !"]
+        else:
+            lines += [" site site_uci", "  authentication-key 7 secret", "  eid-record instance-id 4097 10.16.0.0/12 "
+                      "accept-more-specifics", " exit-site", " !"]
+        lines += ["!", "end"]
+        return "\n".join(lines) + "\n"
+
+    def lisp_site(self, ethernet):
+        out = ["Site Name      Last      Up     Who Last             Inst     EID Prefix",
+               "               Register        Registered           ID"]
+        for dev in self.edges:
+            for j in range(self.endpoints):
+                ip, mac = self.endpoint(dev, j)
+                if ethernet:
+                    out.append(f"site_uci       00:00:04  yes#   {dev['managementIpAddress']}:23456  8188     {mac}/48")
+                else:
+                    out.append(f"site_uci       00:00:04  yes#   {dev['managementIpAddress']}:23456  4097     {ip}/32")
+        return out
+
+    # Instance configured on the device for an address family, None when there is none
+    def instance(self, dev, af):
+        if af == "ipv4":
+            return "4097"
+        if af == "ethernet" and "EDGENODE" in dev["roles"]:
+            return "8188"
+        return None
+
+    def database(self, dev, af):
+        out = []
+        instance = self.instance(dev, af)
+        if instance is None:
+            return out
+        count = self.endpoints if "EDGENODE" in dev["roles"] else 0
+        out += [f"Output for router lisp 0 instance-id {instance}",
+                f"LISP ETR {af} Mapping Database for LISP 0 EID-table {instance} (IID {instance}), LSBs: 0x1",
+                f"Entries total {count}, no-route 0, inactive 0, do-not-register 0", ""]
+        for j in range(count):
+            ip, mac = self.endpoint(dev, j)
+            eid = f"{mac}/48" if af == "ethernet" else f"{ip}/32"
+            out += [f"{eid}, dynamic-eid Campus_IPV4, inherited from default locator-set rloc_x",
+                    "  Locator       Pri/Wgt  Source     State",
+                    f"  {dev['managementIpAddress']}  10/10   cfg-intf   site-self, reachable"]
+        return out
+
+    def map_cache(self, dev, af):
+        out = []
+        instance = self.instance(dev, af)
+        if instance is None:
+            return out
+        count = self.mapcache if "EDGENODE" in dev["roles"] else 0
+        out += [f"Output for router lisp 0 instance-id {instance}",
+                f"LISP {af} Mapping Cache for LISP 0 EID-table {instance} (IID {instance}), {count} entries", ""]
+        for m in range(count):
+            ip, mac, rloc = self.remote(dev, m)
+            eid = f"{mac}/48" if af == "ethernet" else f"{ip}/32"
+            out += [f"{eid}, uptime: 1d02h, expires: 20:00:00, via map-reply, complete",
+                    "  Locator       Uptime    State  Pri/Wgt     Encap-IID",
+                    f"  {rloc}  1d02h     up      10/10        -"]
+        return out
+
+    # Output of a show command, the first line is the command like on a device
+    def output(self, dev, command):
+        split = command.split()
+        out = []
+        if re.match(r"^sh\S* lisp session", command):
+            out += [f"Sessions for VRF default, total: {len(self.cps)}, established: {len(self.cps)}",
+                    "Peer                           State      Up/Down        In/Out    Users"]
+            if "EDGENODE" in dev["roles"]:
+                for cp in self.cps:
+                    out.append(f"{cp['managementIpAddress']}:4342             Up         1d02h          100/90    4")
+            else:
+                for edge in self.edges:
+                    out.append(f"{edge['managementIpAddress']}:23456          Up         1d02h          90/100    2")
+        elif re.match(r"^sh\S* lisp site", command):
+            out += self.lisp_site(False)
+        elif "server" in split and "address-resolution" not in split:
+            out += self.lisp_site(True)
+        elif "database" in split and "lisp" in split:
+            out += self.database(dev, [af for af in ("ipv4", "ipv6", "ethernet") if af in split][0])
+        elif "map-cache" in split:
+            out += self.map_cache(dev, [af for af in ("ipv4", "ipv6", "ethernet") if af in split][0])
+        elif re.match(r"^sh\S* ip route$", command):
+            out += ["Codes: L - local, C - connected, S - static, R - RIP, M - mobile, B - BGP", "",
+                    "Gateway of last resort is not set", "",
+                    f"C        {dev['managementIpAddress']}/32 is directly connected, Loopback0"]
+            for other in self.devices:
+                if other is not dev:
+                    out.append(f"i L2     {other['managementIpAddress']}/32 [115/20] via 10.0.0.1, 1d02h, "
+                               f"TenGigabitEthernet1/1/1")
+        elif re.match(r"^sh\S* device-tracking database", command):
+            out += ["Binding Table has entries, dynamic entries",
+                    "    Network Layer Address  Link Layer Address Interface vlan prlvl age state Time left"]
+            if "EDGENODE" in dev["roles"]:
+                for j in range(self.endpoints):
+                    ip, mac = self.endpoint(dev, j)
+                    out.append(f"DH4 {ip}  {mac}  Gi1/0/{j % 48 + 1}  1021  0024  2mn  REACHABLE  35 s")
+        elif re.match(r"^sh\S* mac add", command):
+            out += ["          Mac Address Table", "-------------------------------------------",
+                    "Vlan    Mac Address       Type        Ports"]
+            if "EDGENODE" in dev["roles"]:
+                for j in range(self.endpoints):
+                    ip, mac = self.endpoint(dev, j)
+                    out.append(f" 1021    {mac}    DYNAMIC     Gi1/0/{j % 48 + 1}")
+        elif re.match(r"^sh\S* cts env", command):
+            out += ["CTS Environment Data", "====================", "Current state = COMPLETE"]
+        elif re.match(r"^sh\S* access-session method dot1x", command) and "EDGENODE" in dev["roles"]:
+            for j in range(self.endpoints):
+                ip, mac = self.endpoint(dev, j)
+                out += [f"            Interface:  GigabitEthernet1/0/{j % 48 + 1}", f"          MAC Address:  {mac}",
+                        f"         IPv4 Address:  {ip}", "                Status:  Authorized",
+                        "       Current Policy:  POLICY_Gi1/0/1", "dot1x              Authc Success",
+                        "mab                Stopped", ""]
+        elif re.match(r"^sh\S* ip mroute", command):
+            group = split[-1]
+            out += [f"({dev['managementIpAddress']}, {group}), 1d02h/00:03:20, flags: FT",
+                    "  Incoming interface: Loopback0, RPF nbr 0.0.0.0",
+                    "  Outgoing interface list:",
+                    "    TenGigabitEthernet1/1/1, Forward/Sparse, 1d02h/00:03:20", ""]
+        return "\n".join([command] + out) + "\n"
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mock = None
+
+    def log_message(self, *args):
+        return
+
+    def send(self, status, data, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key in (headers or {}).keys():
+            self.send_header(key, headers[key])
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def do_GET(self):
+        self.mock.handle(self, "GET")
+
+    def do_POST(self):
+        self.mock.handle(self, "POST")
+
+
+class MockDnac:
+    def __init__(self, fabric, latency=0.0, job_duration=2.0, job_device=0.01, cli_rate=0, api_rate=0):
+        self.fabric = fabric
+        self.latency = latency
+        self.job_duration = job_duration
+        self.job_device = job_device
+        self.cli_rate = cli_rate
+        self.api_rate = api_rate
+        self.tasks = {}
+        self.calls = {}
+        self.accepted = {"cli": [], "all": []}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def family(self, path):
+        for name, part in families:
+            if part in path:
+                return name
+        return "other"
+
+    # Returns the seconds to wait when the request is above the per minute rate, 0 when it is accepted
+    def limited(self, key, rate):
+        if rate == 0:
+            return 0
+        now = time.time()
+        with self.lock:
+            window = [t for t in self.accepted[key] if now - t < 60]
+            if len(window) >= rate:
+                self.accepted[key] = window
+                return max(1, math.ceil(60 - (now - window[0])))
+            window.append(now)
+            self.accepted[key] = window
+        return 0
+
+    def handle(self, req, method):
+        url = urllib.parse.urlsplit(req.path)
+        path = url.path
+        query = urllib.parse.parse_qs(url.query)
+        body = None
+        if method == "POST":
+            length = int(req.headers.get("Content-Length", 0))
+            body = req.rfile.read(length) if length > 0 else b""
+        if path == "/mock/stats":
+            with self.lock:
+                return req.send(200, dict(self.calls))
+        if path == "/mock/reset":
+            with self.lock:
+                self.calls = {}
+            return req.send(200, {})
+        family = self.family(path)
+        with self.lock:
+            self.calls[family] = self.calls.get(family, 0) + 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        wait = self.limited("all", self.api_rate)
+        if wait == 0 and family == "cli":
+            wait = self.limited("cli", self.cli_rate)
+        if wait > 0:
+            with self.lock:
+                self.calls["429"] = self.calls.get("429", 0) + 1
+            return req.send(429, {"message": "Too many requests"}, {"Retry-After": str(wait)})
+        if family == "token":
+            return req.send(200, {"Token": "mock-token"})
+        if req.headers.get("x-auth-token") is None:
+            return req.send(401, {"message": "no token"})
+        if family == "cli":
+            payload = json.loads(body)
+            with self.lock:
+                task = f"task{len(self.tasks)}"
+                duration = self.job_duration + self.job_device * len(payload["deviceUuids"])
+                self.tasks[task] = (time.time() + duration, payload)
+            return req.send(202, {"response": {"taskId": task, "url": f"/api/v1/task/{task}"}, "version": "1.0"})
+        if family == "task":
+            task = path.split("/")[-1]
+            end, payload = self.tasks[task]
+            if time.time() < end:
+                return req.send(200, {"response": {"progress": "CLI Runner request creation", "isError": False}})
+            return req.send(200, {"response": {"progress": json.dumps({"fileId": task}), "endTime": int(end * 1000),
+                                               "isError": False}})
+        if family == "file":
+            end, payload = self.tasks[path.split("/")[-1]]
+            results = []
+            for uuid in payload["deviceUuids"]:
+                dev = self.fabric.byid[uuid]
+                outputs = {}
+                for command in payload["commands"]:
+                    outputs[command] = self.fabric.output(dev, command)
+                results.append({"deviceUuid": uuid, "commandResponses": {"SUCCESS": outputs, "FAILURE": {},
+                                                                          "BLACKLISTED": {}}})
+            return req.send(200, results)
+        if family == "site":
+            return req.send(200, {"response": self.fabric.sites})
+        if family == "fabric-site":
+            site = query.get("siteNameHierarchy", [""])[0]
+            if site == self.fabric.fabric_site:
+                return req.send(200, {"status": "success", "fabricName": "MockFabric", "siteNameHierarchy": site})
+            return req.send(200, {"status": "failed", "description": "Site is not a fabric site"})
+        if family == "membership":
+            devices = []
+            for start in range(0, len(self.fabric.devices), 500):
+                members = []
+                for dev in self.fabric.devices[start:start + 500]:
+                    members.append({key: dev[key] for key in ("id", "hostname", "managementIpAddress",
+                                                              "softwareVersion", "reachabilityStatus")})
+                devices.append({"response": members})
+            return req.send(200, {"site": {"response": []}, "device": devices})
+        if family == "sda-device":
+            dev = self.fabric.byip.get(query.get("deviceIPAddress", [""])[0])
+            if dev is None:
+                return req.send(200, {"response": {"status": "failed", "roles": []}})
+            return req.send(200, {"response": {"status": "success", "roles": dev["roles"], "name": dev["hostname"]}})
+        if family == "config":
+            return req.send(200, {"response": self.fabric.config(self.fabric.byid[path.split("/")[-2]])})
+        if family == "network-device":
+            devices = self.fabric.devices
+            if path.split("/")[-1] != "network-device":
+                return req.send(200, {"response": self.inventory(self.fabric.byid[path.split("/")[-1]])})
+            if "reachabilityStatus" in query.keys():
+                devices = [dev for dev in devices if dev["reachabilityStatus"] == query["reachabilityStatus"][0]]
+            if "managementIpAddress" in query.keys():
+                devices = [dev for dev in devices if dev["managementIpAddress"] == query["managementIpAddress"][0]]
+            offset = int(query.get("offset", ["1"])[0])
+            limit = int(query.get("limit", ["500"])[0])
+            return req.send(200, {"response": [self.inventory(dev) for dev in devices[offset - 1:offset - 1 + limit]]})
+        return req.send(404, {"message": f"{path} not implemented by MockDnac"})
+
+    def inventory(self, dev):
+        return {key: dev[key] for key in dev.keys() if key not in ("roles", "index")}
+
+    # Starts the server in a background thread and returns the port it listens on
+    def start(self, port=0, certfile=None, keyfile=None):
+        handler = type("Handler", (MockHandler,), {"mock": self})
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.server.daemon_threads = True
+        if certfile is not None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address[1]
+
+    def stop(self):
+        self.server.shutdown()
+        return
+
+
+def main(argv):
+    usage = 'MockDnac.py -n <devices> -e <endpoints per edge> -m <map-cache entries> -p <port> ' \
+            '-l <latency> -j <job duration> -r <cli requests per minute> -a <api requests per minute> ' \
+            '-u <unreachable edges> -c <certfile> -k <keyfile>'
+    try:
+        opts, args = getopt.getopt(argv, "hn:e:m:p:l:j:r:a:u:c:k:")
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    settings = {"n": "50", "e": "10", "m": "50", "p": "0", "l": "0", "j": "2", "r": "0", "a": "0", "u": "0",
+                "c": None, "k": None}
+    for opt, arg in opts:
+        if opt == "-h":
+            print(usage)
+            sys.exit()
+        settings[opt[1]] = arg
+    fabric = MockFabric(int(settings["n"]), int(settings["e"]), int(settings["m"]), int(settings["u"]))
+    mock = MockDnac(fabric, float(settings["l"]), float(settings["j"]), cli_rate=int(settings["r"]),
+                    api_rate=int(settings["a"]))
+    port = mock.start(int(settings["p"]), settings["c"], settings["k"])
+    scheme = "https" if settings["c"] is not None else "http"
+    print(f"MockDnac listening on {scheme}://127.0.0.1:{port} with {fabric.count} devices", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
+    return
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -15,17 +15,38 @@ or implied.
 """
 
 
+import gzip
 import os
 import re
 import DNAC_Connector
+import LogWriter
 import ParseCommands
 import Analysis
 import random
 
 
-# Extract all show commands from .txt files and run parsing script on each command
+# Extract all show commands from .txt (or compressed .txt.gz) files and run parsing script on each command.
+# Logs written by SDA Digger have an index with the position of every command, those are read directly.
 def parsetext(indir, file, dnac_core):
-    fd = open(indir + "/" + file, "r")
+    entries = LogWriter.read_index(indir + "/" + file)
+    if entries is not None:
+        hostname = file.split(".")[0]
+        dnac_core.add(["Global", "Devices", hostname, {"Name": hostname}])
+        parsed = set()
+        for entry in entries:
+            # repeated outputs refer to an output that is already parsed, the first reference to the output
+            # store of an output logged in an earlier session is parsed
+            if entry.get("ref") is True and entry.get("hash") in parsed:
+                continue
+            parsed.add(entry.get("hash"))
+            command = LogWriter.read_output(indir + "/" + file, entry)
+            if re.match(r".*\n.*", command):
+                ParseCommands.ParseSingleDev(command, hostname, dnac_core)
+        return
+    if file.endswith(".gz"):
+        fd = gzip.open(indir + "/" + file, "rt")
+    else:
+        fd = open(indir + "/" + file, "r")
     hostname = file.split(".")[0]
     parsed = []
     cmd = ""
@@ -87,7 +108,7 @@ def ParseBundle(dnac_core, indir):
     if files is None:
         return
     for file in files:
-        if re.match(r".*\.txt$", file):
+        if re.match(r".*\.txt(\.gz)?$", file):
             parsetext(indir, file, dnac_core)
     build_dnac_data(dnac, dnac_core)
     Analysis.Config2Fabric(dnac, dnac_core)
@@ -189,6 +189,7 @@ def ParseWLCConfig(output, hostname, dnac_core):
 
 
 def ParseConfig(output, hostname, dnac_core):
+    hostname = AnalysisCore.intern(hostname)
     if type(output) != list:
         output = re.split(r"\n", output)
     splits = splititup(output, "^!")
@@ -213,28 +214,26 @@ def ParseConfig(output, hostname, dnac_core):
 
 def ParseDT(output, key, hostname, dnac_core):
     start_dts = ["L", "API", "ND", "DH4", "ARP", "DH6"]
+    rows = []
     for lines in output:
         line_split = lines.split()
         if len(line_split) > 1:
             if line_split[0] in start_dts:
-                dnac_core.add(
-                    ["Global", "Device-tracking", hostname, line_split[4], line_split[1], {"mac": line_split[2],
-                                                                                           "source": line_split[0],
-                                                                                           "interface": line_split[3],
-                                                                                           "vlan": line_split[4],
-                                                                                           "age": line_split[6],
-                                                                                           "state": line_split[7]}])
+                rows.append([line_split[4], line_split[1],
+                             AnalysisCore.TrackingEntry(line_split[2], line_split[0], line_split[3], line_split[4],
+                                                        line_split[6], line_split[7])])
+    dnac_core.add_many(["Global", "Device-tracking", hostname], rows)
     return
 
 
 def ParseMac(output, key, hostname, dnac_core):
-    tdict = {}
+    rows = []
     for lines in output:
         line_split = lines.split()
         if len(line_split) > 3:
             if re.match(r"[12]\d\d\d", line_split[0]):
-                dnac_core.add(["Global", "mac", hostname, line_split[0], line_split[1],
-                               {"Source": line_split[2], "Int": line_split[3]}])
+                rows.append([line_split[0], line_split[1], AnalysisCore.MacEntry(line_split[2], line_split[3])])
+    dnac_core.add_many(["Global", "mac", hostname], rows)
 
 
 def ParseAccess(output, key, hostname, dnac_core):
@@ -296,6 +295,7 @@ def ParseAAA(output, key, hostname, dnac_core):
 
 
 def ParseSingleDev(output, hostname, dnac_core):
+    hostname = AnalysisCore.intern(hostname)
     command = re.split(r"\n", output)[0]
     output = re.split(r"\n", output)
     splitkey = re.split(r'\s', command)
@@ -31,8 +31,9 @@ def splititup(output, divider):
 def LispMapCache(output, hostname, dnac_core):
     splits = (splititup(output, "^Output"))
     for spli in splits:
-        linstance = str.split(spli[0])[-1]
+        linstance = AnalysisCore.intern(str.split(spli[0])[-1])
         leid = ""
+        rows = []
         if len(spli) > 0:
             for eid in spli[1:]:
                 lsp = eid.split()
@@ -53,9 +54,9 @@ def LispMapCache(output, hostname, dnac_core):
                         lrloc = lsp[0]
                         if lsp[0] == "Encapsulating" or lsp[0] == "Negative":
                             lrloc = eid.strip()
-                        tdict = {"RLOC": lrloc, "Source": lsource, "State": laction, "Uptime": lutime,
-                                 "Expired": lexpire}
-                        dnac_core.add(["lisp", "map-cache", hostname, linstance, leid, tdict])
+                        tdict = AnalysisCore.MapCacheEntry(lrloc, lsource, laction, lutime, lexpire)
+                        rows.append([leid, tdict])
+        dnac_core.add_many(["lisp", "map-cache", hostname, linstance], rows)
 
 
 def LispDatabase(output, hostname, instance, AF, dnac_core):
@@ -65,8 +66,9 @@ def LispDatabase(output, hostname, instance, AF, dnac_core):
     else:
         splits.append(output)
     for spli in splits:
-        linstance = str.split(spli[0])[-1]
+        linstance = AnalysisCore.intern(str.split(spli[0])[-1])
         leid = ""
+        rows = []
         if len(spli) > 0:
             for eid in spli[1:]:
                 lsp = eid.split()
@@ -83,10 +85,9 @@ def LispDatabase(output, hostname, instance, AF, dnac_core):
                     elif re.match(r"^\d*\.\d*\.\d*\.\d*$", lsp[0]):
                         lestate = lsp[3:]
                         #                       print (lsp)
-                        tdict = {"Conf": lsp[2], "Source": lsource, "Dyn EID": ldrange, "State": lestate, "AF": AF,
-                                 "RLOC": lsp[0]}
-                        dnac_core.add(["lisp", "database", hostname, linstance, leid, tdict])
-
+                        tdict = AnalysisCore.DatabaseEntry(lsp[2], lsource, ldrange, lestate, AF, lsp[0])
+                        rows.append([leid, tdict])
+        dnac_core.add_many(["lisp", "database", hostname, linstance], rows)
     return
 
 
@@ -205,12 +206,12 @@ def LispSite(output, hostname, dnac_core):
         splitline = lines.split()
         if len(splitline) > 4 and re.search(r"4\d\d\d", lines):
             if instance == 0:
-                instance = splitline[-2]
+                instance = AnalysisCore.intern(splitline[-2])
             elif instance != splitline[-2]:
                 dnac_core.add(["lisp", "site", "ip", hostname, instance, tdict])
                 tdict = dict()
-                instance = splitline[-2]
-            tdict[splitline[-1]] = {"Last Register": splitline[-3], "Status": splitline[-4], "Last Time": splitline[-5]}
+                instance = AnalysisCore.intern(splitline[-2])
+            tdict[splitline[-1]] = AnalysisCore.SiteEntry(splitline[-3], splitline[-4], splitline[-5])
     if len(tdict) > 0:
         dnac_core.add(["lisp", "site", "ip", hostname, instance, tdict])
 
@@ -222,12 +223,12 @@ def LispEthServer(output, hostname, dnac_core):
         splitline = lines.split()
         if len(splitline) > 4 and re.match(r".*\..*\..*\/48", splitline[-1]):
             if instance == 0:
-                instance = splitline[-2]
+                instance = AnalysisCore.intern(splitline[-2])
             elif instance != splitline[-2]:
                 dnac_core.add(["lisp", "site", "ethernet", hostname, instance, tdict])
                 tdict = dict()
-                instance = splitline[-2]
-            tdict[splitline[-1]] = {"Last Register": splitline[-3], "Status": splitline[-4], "Last Time": splitline[-5]}
+                instance = AnalysisCore.intern(splitline[-2])
+            tdict[splitline[-1]] = AnalysisCore.SiteEntry(splitline[-3], splitline[-4], splitline[-5])
     if len(tdict) > 0:
         dnac_core.add(["lisp", "site", "ethernet", hostname, instance, tdict])
         # print(f"{instance}{tdict}")
@@ -0,0 +1,439 @@
+"""Copyright (c) 2021 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+import atexit
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+import AnalysisCore
+import LogWriter
+import ParseCommands
+
+
+# Cache of DNAC GET responses kept in memory and on disk (one json file per URL) so a restart or new fabric
+# selection does not have to fetch the inventory and configurations again. How long a response stays
+# fresh depends on the first rule in ttl that is part of the URL, 0 means the URL is never cached. Only
+# responses smaller then memory_limit bytes are also kept in memory, large ones like configurations are
+# read back from disk when needed.
+class ResponseCache:
+    def __init__(self, directory, server):
+        self.directory = directory
+        self.server = server
+        # the inventory queries carry the lastUpdateTime the ConfigCache relies on, they are always fetched
+        self.ttl = [("reachabilityStatus", 0), ("/task/", 0), ("/file/", 0), ("/network-device-poller/", 0),
+                    ("/config", 0), ("/network-device?", 0), ("/business/sda/", 3600),
+                    ("/membership/", 900), ("/network-device", 900), ("/site", 86400)]
+        self.default_ttl = 0
+        self.memory_limit = 64 * 1024
+        self.memory = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def freshness(self, url):
+        for part, ttl in self.ttl:
+            if part in url:
+                return ttl
+        return self.default_ttl
+
+    def filename(self, url):
+        key = hashlib.sha1(f"{self.server}{url}".encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, url):
+        ttl = self.freshness(url)
+        if ttl == 0:
+            return None
+        with self.lock:
+            entry = self.memory.get(url)
+        if entry is None:
+            filename = self.filename(url)
+            try:
+                with open(filename, "r") as fd:
+                    entry = json.load(fd)
+                size = os.path.getsize(filename)
+            except (OSError, ValueError):
+                return None
+            if entry.get("url") != url:
+                return None
+            if size < self.memory_limit:
+                with self.lock:
+                    self.memory[url] = entry
+        if time.time() - entry["time"] > ttl:
+            return None
+        self.hits = self.hits + 1
+        return entry["data"]
+
+    def put(self, url, data):
+        if self.freshness(url) == 0:
+            return
+        entry = {"url": url, "time": time.time(), "data": data}
+        content = json.dumps(entry)
+        with self.lock:
+            if len(content) < self.memory_limit:
+                self.memory[url] = entry
+            else:
+                self.memory.pop(url, None)
+        filename = self.filename(url)
+        tmpname = f"{filename}.{threading.get_ident()}"
+        with open(tmpname, "w") as fd:
+            fd.write(content)
+        os.replace(tmpname, filename)
+        return
+
+    # Removes all cached responses, or only the ones whose URL contains part
+    def invalidate(self, part=None):
+        with self.lock:
+            for url in list(self.memory.keys()):
+                if part is None or part in url:
+                    del self.memory[url]
+        for file in os.listdir(self.directory):
+            if not file.endswith(".json"):
+                continue
+            if part is not None:
+                try:
+                    with open(os.path.join(self.directory, file), "r") as fd:
+                        url = json.load(fd).get("url", "")
+                except (OSError, ValueError):
+                    url = ""
+                if part not in url:
+                    continue
+            try:
+                os.remove(os.path.join(self.directory, file))
+            except OSError:
+                pass
+        return
+
+
+# Cache of the parsed parts of device configurations (LISP, SVI, Loopback0 and MTU), keyed by device UUID.
+# When DNAC reports the same last update time for the device the configuration is not downloaded at all,
+# when the downloaded configuration has the same hash as before it is not parsed again.
+class ConfigCache:
+    paths = [["lisp", "config"], ["lisp", "roles"], ["lisp", "svi_interface"], ["Global", "MTU"],
+             ["Global", "Devices"]]
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.skipped = 0
+        self.parsed = 0
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def load(self, uuid):
+        with self.lock:
+            entry = self.entries.get(uuid)
+        if entry is None:
+            try:
+                with open(os.path.join(self.directory, f"{uuid}.json"), "r") as fd:
+                    entry = json.load(fd)
+            except (OSError, ValueError):
+                return None
+            with self.lock:
+                self.entries[uuid] = entry
+        return entry
+
+    def store(self, uuid, entry):
+        with self.lock:
+            self.entries[uuid] = entry
+        filename = os.path.join(self.directory, f"{uuid}.json")
+        tmpname = f"{filename}.{threading.get_ident()}"
+        with open(tmpname, "w") as fd:
+            json.dump(entry, fd)
+        os.replace(tmpname, filename)
+        return
+
+    # Returns True and adds the cached information when the device has not been updated since it was cached
+    def unchanged(self, uuid, hostname, updated, dnac_core):
+        entry = self.load(uuid)
+        if entry is None or updated is None or entry["updated"] != updated or entry["hostname"] != hostname:
+            return False
+        self.skipped = self.skipped + 1
+        self.merge(entry["extract"], dnac_core)
+        return True
+
+    def parse(self, uuid, hostname, updated, config, dnac_core):
+        chash = hashlib.sha256(config.encode("utf-8")).hexdigest()
+        entry = self.load(uuid)
+        if entry is None or entry["hash"] != chash or entry["hostname"] != hostname:
+            # parse into an empty structure, seeded with the device entry ParseLoop0 relies on
+            scratch = AnalysisCore.Analysis_Core()
+            device = dnac_core.get(["Global", "Devices", hostname])
+            if device is not None:
+                scratch.add(["Global", "Devices", hostname, copy.deepcopy(device)])
+            ParseCommands.ParseConfig(config, hostname, scratch)
+            extract = []
+            for path in self.paths:
+                value = scratch.get([*path, hostname])
+                if value is not None:
+                    extract.append([*path, hostname, value])
+            entry = {"hostname": hostname, "hash": chash, "extract": extract}
+            self.parsed = self.parsed + 1
+        else:
+            self.skipped = self.skipped + 1
+        entry["updated"] = updated
+        self.store(uuid, entry)
+        self.merge(entry["extract"], dnac_core)
+        return
+
+    def merge(self, extract, dnac_core):
+        for clist in extract:
+            self.merge_path(dnac_core, clist[:-1], clist[-1])
+        return
+
+    # Adds value at path, like Analysis_Core.add existing entries are kept
+    def merge_path(self, dnac_core, path, value):
+        current = dnac_core.get(path)
+        if current is None:
+            dnac_core.add([*path, copy.deepcopy(value)])
+        elif type(current) is dict and type(value) is dict:
+            for key in value.keys():
+                self.merge_path(dnac_core, [*path, key], value[key])
+        return
+
+    def invalidate(self):
+        with self.lock:
+            self.entries = {}
+        for file in os.listdir(self.directory):
+            if file.endswith(".json"):
+                try:
+                    os.remove(os.path.join(self.directory, file))
+                except OSError:
+                    pass
+        return
+
+
+# Passes the calls of a parser on to dnac_core and records the changes made, so they can be applied again
+# without parsing the output
+class ParseRecorder:
+    def __init__(self, dnac_core):
+        self.dnac_core = dnac_core
+        self.ops = []
+
+    def add(self, clist):
+        self.ops.append(["add", clist])
+        return self.dnac_core.add(clist)
+
+    def add_many(self, prefix, rows):
+        rows = list(rows)
+        self.ops.append(["add_many", prefix, rows])
+        return self.dnac_core.add_many(prefix, rows)
+
+    def modify(self, clist, label, value):
+        self.ops.append(["modify", clist, label, value])
+        return self.dnac_core.modify(clist, label, value)
+
+    def upsert(self, clist, label, value):
+        self.ops.append(["upsert", clist, label, value])
+        return self.dnac_core.upsert(clist, label, value)
+
+    def get(self, clist):
+        return self.dnac_core.get(clist)
+
+
+# Cache of the changes ParseSingleDev made for an output, keyed by the content hash of (host, command,
+# output). An output seen before is not parsed again, the recorded changes are applied to dnac_core
+# instead. Configurations are left to the ConfigCache as their parsing depends on what is already known.
+# Most outputs (map-cache, device-tracking, sessions) carry uptimes and ages and are never seen twice, so
+# the changes are only recorded once a hash comes back, the hashes seen are kept in the seen file (at
+# most max_seen, appended in batches of seen_batch). The cache files are removed least recently used first once they take more than
+# max_size bytes. The cache keys include a hash of the parser sources, a new version of the parsers
+# starts a new cache and the files of older versions are removed.
+class ParseCache:
+    sources = ["AnalysisCore.py", "ParseCommands.py", "ParseLisp.py"]
+
+    def __init__(self, directory):
+        self.directory = directory
+        salt = hashlib.sha256()
+        for source in self.sources:
+            try:
+                with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), source), "rb") as fd:
+                    salt.update(fd.read())
+            except OSError:
+                pass
+        self.salt = salt.hexdigest()[:16]
+        self.memory_limit = 64 * 1024
+        self.max_size = 256 * 1024 * 1024
+        self.max_seen = 100000
+        self.memory = {}
+        self.lock = threading.Lock()
+        self.skipped = 0
+        self.parsed = 0
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.size = 0
+        for entry in os.scandir(self.directory):
+            if not entry.name.startswith(self.salt):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+            elif entry.name.endswith(".json"):
+                self.size = self.size + entry.stat().st_size
+        self.seenfile = os.path.join(self.directory, f"{self.salt}-seen.txt")
+        self.seen = []
+        try:
+            with open(self.seenfile, "r") as fd:
+                self.seen = fd.read().split()
+        except OSError:
+            pass
+        if len(self.seen) > self.max_seen:
+            self.seen = self.seen[-(self.max_seen // 2):]
+            with open(self.seenfile, "w") as fd:
+                fd.write("".join([f"{chash}\n" for chash in self.seen]))
+        self.seen = set(self.seen)
+        self.seen_batch = 256
+        self.pending = []
+        atexit.register(self.flush)
+
+    # Returns True when the hash was seen before, otherwise remembers it
+    def sighted(self, chash):
+        with self.lock:
+            if chash in self.seen:
+                return True
+            self.seen.add(chash)
+            self.pending.append(chash)
+            if len(self.pending) < self.seen_batch:
+                return False
+        self.flush()
+        return False
+
+    # Appends the hashes seen since the last flush to the seen file
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+            if len(pending) == 0:
+                return
+            try:
+                with open(self.seenfile, "a") as fd:
+                    fd.write("".join([f"{chash}\n" for chash in pending]))
+            except OSError:
+                # cache directory removed, the hashes are seen for the first time again next session
+                pass
+        return
+
+    def load(self, chash):
+        with self.lock:
+            ops = self.memory.get(chash)
+        if ops is None:
+            filename = os.path.join(self.directory, f"{self.salt}-{chash}.json")
+            try:
+                with open(filename, "r") as fd:
+                    ops = fd.read()
+                # keeps the file from being pruned as least recently used
+                os.utime(filename)
+            except OSError:
+                return None
+        return ops
+
+    def store(self, chash, ops):
+        if len(ops) < self.memory_limit:
+            with self.lock:
+                self.memory[chash] = ops
+        filename = os.path.join(self.directory, f"{self.salt}-{chash}.json")
+        tmpname = f"{filename}.{threading.get_ident()}"
+        with open(tmpname, "w") as fd:
+            fd.write(ops)
+        os.replace(tmpname, filename)
+        with self.lock:
+            self.size = self.size + len(ops)
+            prune = self.size > self.max_size
+        if prune:
+            self.prune()
+        return
+
+    # Removes the least recently used cache files until they take less than 80% of max_size
+    def prune(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        size = sum([file[1] for file in files])
+        for mtime, fsize, path in files:
+            if size <= self.max_size * 0.8:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size = size - fsize
+            with self.lock:
+                self.memory.pop(os.path.basename(path)[len(self.salt) + 1:-len(".json")], None)
+        with self.lock:
+            self.size = size
+        return
+
+    def parse(self, output, hostname, dnac_core, chash=None):
+        command = output.split("\n")[0]
+        splitkey = command.split()
+        if len(splitkey) > 1 and splitkey[1].startswith("run"):
+            ParseCommands.ParseSingleDev(output, hostname, dnac_core)
+            return
+        if chash is None:
+            chash = LogWriter.output_hash(hostname, command, output)
+        ops = self.load(chash)
+        if ops is not None:
+            try:
+                ops = json.loads(ops, object_hook=AnalysisCore.record_hook)
+            except ValueError:
+                ops = None
+        if ops is None and not self.sighted(chash):
+            # first time this output is seen, it will most likely not come back
+            ParseCommands.ParseSingleDev(output, hostname, dnac_core)
+            self.parsed = self.parsed + 1
+            return
+        if ops is None:
+            recorder = ParseRecorder(dnac_core)
+            ParseCommands.ParseSingleDev(output, hostname, recorder)
+            self.store(chash, json.dumps(recorder.ops, default=AnalysisCore.record_json))
+            self.parsed = self.parsed + 1
+            return
+        for op in ops:
+            if op[0] == "add":
+                dnac_core.add(op[1])
+            elif op[0] == "add_many":
+                dnac_core.add_many(op[1], op[2])
+            elif op[0] == "upsert":
+                dnac_core.upsert(op[1], op[2], op[3])
+            else:
+                dnac_core.modify(op[1], op[2], op[3])
+        self.skipped = self.skipped + 1
+        return
+
+    def invalidate(self):
+        with self.lock:
+            self.memory = {}
+            self.seen = set()
+            self.pending = []
+            self.size = 0
+        for file in os.listdir(self.directory):
+            if file.endswith(".json") or file.endswith("-seen.txt"):
+                try:
+                    os.remove(os.path.join(self.directory, file))
+                except OSError:
+                    pass
+        return
@@ -24,6 +24,8 @@ import ParseCommands
 import Analysis
 from getpass import getpass
 import ParseBundle
+import LogWriter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 edge_cmd_list = [["show lisp session", "show lisp instance * ethernet database", "sh lisp instance-id * ipv4 database",
                   "sh lisp instance-id * ipv6 database", "show device-tracking database"]
@@ -57,27 +59,57 @@ def BuildIdlist(dnac, dnac_core, roles):
     return devid
 
 
-def printraw(ret):
+def printraw(dnac, ret):
     answer = input("Analysis complete, print outputs y/n:")
     if answer == "y":
         for responses in ret:
             print(f"***********{responses['host']}**********")
-            print(f"{responses['output']}")
+            print(f"{dnac.command_output(responses)}")
     return
 
 
-def check_dev(dnac, dnac_core, fabric, dev):
-    resp = dnac.geturl(f"/dna/intent/api/v1/business/sda/device?deviceIPAddress={dev['managementIpAddress']}")
+# Returns a command_run handler parsing every output into dnac_core as soon as it is received, outputs
+# parsed before are taken from the parse cache
+def parser(dnac, dnac_core):
+    def parse(responses):
+        if dnac.parsed is None:
+            ParseCommands.ParseSingleDev(responses["output"], responses["host"], dnac_core)
+        else:
+            dnac.parsed.parse(responses["output"], responses["host"], dnac_core, responses.get("hash"))
+    return parse
+
+
+# Retrieves the complete network device inventory in pages of 500 devices, indexed by management IP
+def get_inventory(dnac):
+    inventory = {}
+    offset = 1
+    while True:
+        resp = dnac.geturl(f"/dna/intent/api/v1/network-device?offset={offset}&limit=500")
+        response = resp.get("response")
+        if response is None:
+            break
+        for device in response:
+            inventory[device['managementIpAddress']] = device
+        if len(response) < 500:
+            break
+        offset = offset + 500
+    return inventory
+
+
+def get_roles(dnac, dev):
+    return dnac.geturl(f"/dna/intent/api/v1/business/sda/device?deviceIPAddress={dev['managementIpAddress']}")
+
+
+def check_dev(dnac, dnac_core, fabric, dev, resp, netdev):
     if "response" in resp.keys():
         if resp['response']['status'] == "success":
             roles = resp['response']['roles']
             print(f"{dev['hostname']} has role(s) {resp['response']['roles']}")
-            resp = dnac.geturl(f"/dna/intent/api/v1/network-device?managementIpAddress={dev['managementIpAddress']}")
-            dnac.devices[dev['hostname']] = resp.get("response")
+            dnac.devices[dev['hostname']] = netdev
             # print(dev["hostname"])
-            # print (resp['response'][0]['reachabilityStatus'])
+            # print (netdev[0]['reachabilityStatus'])
             if len(roles) > 0:
-                uuid = resp['response'][0]['id']
+                uuid = netdev[0]['id']
                 for role in roles:
                     dnac_core.add(["devices", fabric, role, dev['managementIpAddress'],
                                    {"name": dev["hostname"], "IOS": dev['softwareVersion'], "id": uuid,
@@ -95,6 +127,37 @@ def check_dev(dnac, dnac_core, fabric, dev):
     return
 
 
+# Discovers all fabric member devices: the inventory is pulled in bulk and the SDA roles are looked up
+# in parallel, after which the devices are added in membership order
+def check_devs(dnac, dnac_core, fabric, devs):
+    if len(devs) == 0:
+        return
+    inventory = get_inventory(dnac)
+    with ThreadPoolExecutor(max_workers=dnac.workers) as pool:
+        roles = list(pool.map(lambda dev: get_roles(dnac, dev), devs))
+    for dev, resp in zip(devs, roles):
+        if dev['managementIpAddress'] in inventory.keys():
+            netdev = [inventory[dev['managementIpAddress']]]
+        else:
+            resp_dev = dnac.geturl(
+                f"/dna/intent/api/v1/network-device?managementIpAddress={dev['managementIpAddress']}")
+            netdev = resp_dev.get("response")
+        check_dev(dnac, dnac_core, fabric, dev, resp, netdev)
+    return
+
+
+def get_fabric_site(dnac, site):
+    return dnac.geturl(f"/dna/intent/api/v1/business/sda/fabric-site?siteNameHierarchy={site.replace(' ', '+')}")
+
+
+def in_fabric_site(site, fabric_sites):
+    parts = site.split("/")
+    for i in range(1, len(parts)):
+        if "/".join(parts[:i]) in fabric_sites:
+            return True
+    return False
+
+
 def build_hierarch(dnac, dnac_core):
     resp = dnac.geturl("/dna/intent/api/v1/site")
     sites = resp["response"]
@@ -108,12 +171,21 @@ def build_hierarch(dnac, dnac_core):
     print("Discovered Areas/Buildings/floors:")
     [print(x) for x in site_view]
     fabric_list = []
+    fabric_sites = set()
+    levels = {}
     for site in site_view:
-        resp = dnac.geturl(f"/dna/intent/api/v1/business/sda/fabric-site?siteNameHierarchy={site.replace(' ', '+')}")
-        if resp['status'] == "success":
-            fabric_list.append(resp['fabricName'])
-            dnac.topo['fabrics'][resp['fabricName']] = {"site": site, "id": dnac.topo['sites'][site]}
-            dnac_core.add(["topology", site, {"fabric": dnac.topo['fabrics'][resp['fabricName']]}])
+        levels.setdefault(site.count("/"), []).append(site)
+    # Sites are checked one hierarchy level at a time in parallel. Fabric sites can not be nested, so
+    # buildings and floors below a site already found to be a fabric site are not checked anymore.
+    with ThreadPoolExecutor(max_workers=dnac.workers) as pool:
+        for level in sorted(levels.keys()):
+            sites = [site for site in levels[level] if not in_fabric_site(site, fabric_sites)]
+            for site, resp in zip(sites, pool.map(lambda site: get_fabric_site(dnac, site), sites)):
+                if resp['status'] == "success":
+                    fabric_sites.add(site)
+                    fabric_list.append(resp['fabricName'])
+                    dnac.topo['fabrics'][resp['fabricName']] = {"site": site, "id": dnac.topo['sites'][site]}
+                    dnac_core.add(["topology", site, {"fabric": dnac.topo['fabrics'][resp['fabricName']]}])
 
 
 def find_wlc(dnac, dnac_core, resp):
@@ -150,13 +222,50 @@ def find_wlc(dnac, dnac_core, resp):
     return
 
 
+def get_config(dnac, dev):
+    return dev, dnac.geturl(f"/dna/intent/api/v1/network-device/{dev['id']}/config")
+
+
+# Last time DNAC updated the device in its inventory, used to detect unchanged configurations
+def last_updated(dnac, hostname):
+    netdev = dnac.devices.get(hostname)
+    if netdev is None or len(netdev) == 0:
+        return None
+    return netdev[0].get("lastUpdateTime")
+
+
+def parse_config(dnac, dnac_core, dev, resp):
+    dnac.configs.parse(dev["id"], dev["name"], last_updated(dnac, dev["name"]), resp["response"], dnac_core)
+    return
+
+
+# Downloads the running configurations of devices with up to dnac.workers downloads in flight. Each
+# configuration is parsed as soon as its download finishes, so only a few configurations are in memory.
+# Devices DNAC has not updated since the last import are taken from the configuration cache.
+def fetch_configs(dnac, dnac_core, devices):
+    pending = set()
+    with ThreadPoolExecutor(max_workers=dnac.workers) as pool:
+        for dev in devices:
+            if dnac.configs.unchanged(devices[dev]["id"], devices[dev]["name"],
+                                      last_updated(dnac, devices[dev]["name"]), dnac_core):
+                continue
+            pending.add(pool.submit(get_config, dnac, devices[dev]))
+            if len(pending) >= dnac.workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    parse_config(dnac, dnac_core, *future.result())
+        for future in pending:
+            parse_config(dnac, dnac_core, *future.result())
+    return
+
+
 def check_fabric(fabric, dnac, dnac_core):
     #   for fabric in fabric_list:
     print(f"Discovered devices in Fabric {fabric} :")
     resp = dnac.geturl(f"/dna/intent/api/v1/membership/{dnac.topo['fabrics'][fabric]['id']}")
     devices = resp['device']
     find_wlc(dnac, dnac_core, resp)
-    [[check_dev(dnac, dnac_core, fabric, y) for y in x.get('response')] for x in devices]
+    check_devs(dnac, dnac_core, fabric, [y for x in devices for y in x.get('response')])
     print(f"Importing CP information for fabric {fabric}")
     cp = dnac_core.get(["devices", fabric, "MAPSERVER"])
     if cp is None:
@@ -167,10 +276,7 @@ def check_fabric(fabric, dnac, dnac_core):
                                 "sh lisp instance-id * ethernet server address-resolution",
                                 "show lisp instance-id * ipv4 database",
                                 "show lisp instance-id * ipv6 database", "show lisp instance-id * ethernet database"],
-                               [cp[cp_node]["id"]])
-        for responses in ret:
-            # print (responses["output"])
-            ParseCommands.ParseSingleDev(responses["output"], responses["host"], dnac_core)
+                               [cp[cp_node]["id"]], parser(dnac, dnac_core))
         print(f"Completed {cp_node} ")
     edges = []
     edge = {}
@@ -181,11 +287,7 @@ def check_fabric(fabric, dnac, dnac_core):
     if dnac_core.get(["devices", fabric, "MAPSERVER"]) is not None:
         edge.update(dnac_core.get(["devices", fabric, "MAPSERVER"]))
     print(f"Importing configurations for fabric {fabric}")
-    for edge_dev in edge:
-        edges.append(edge[edge_dev]["id"])
-        eid = edge[edge_dev]["id"]
-        resp = dnac.geturl(f"/dna/intent/api/v1/network-device/{eid}/config")
-        ParseCommands.ParseConfig(resp["response"], edge[edge_dev]["name"], dnac_core)
+    fetch_configs(dnac, dnac_core, edge)
     Analysis.Config2Fabric(dnac, dnac_core)
     Analysis.CP2Fabric(dnac, dnac_core)
     return
@@ -221,27 +323,20 @@ def Build_Lisp_Fabric(dnac, dnac_core, fabric):
 def SessionAnalysis(dnac, dnac_core):
     edge = dnac_core.get(["devices", dnac.fabric, "EDGENODE"])
     print(f"Importing basic edge information for fabric {dnac.fabric}")
-    edges = []
+    edge_devs = list(edge.keys())
     i = 0
-    t = 0
-    for edge_dev in edge:
-        edges.append(edge[edge_dev]["id"])
-        eid = edge[edge_dev]["id"]
-        resp = dnac.geturl(f"/dna/intent/api/v1/network-device/{eid}/config")
-        # print(edge[edge_dev])
-        ParseCommands.ParseConfig(resp["response"], edge[edge_dev]["name"], dnac_core)
-        i = i + 1
-        t = t + 1
-        if len(edges) > 100 or i == len(edge):
-            for cmd in session_cmd_list:
-                ret = dnac.command_run(cmd, edges)
-                for responses in ret:
-                    ParseCommands.ParseSingleDev(responses["output"], responses["host"], dnac_core)
-            print(f"Completed import on {t} edges , total imported {i}")
-            t = 0
-            edges = []
+    for start in range(0, len(edge_devs), 101):
+        chunk = {}
+        for edge_dev in edge_devs[start:start + 101]:
+            chunk[edge_dev] = edge[edge_dev]
+        fetch_configs(dnac, dnac_core, chunk)
+        edges = [chunk[edge_dev]["id"] for edge_dev in chunk]
+        for cmd in session_cmd_list:
+            ret = dnac.command_run(cmd, edges, parser(dnac, dnac_core))
+        i = i + len(edges)
+        print(f"Completed import on {len(edges)} edges , total imported {i}")
     Analysis.CheckLispSession(dnac, dnac_core)
-    printraw(ret)
+    printraw(dnac, ret)
     return
 
 
@@ -254,12 +349,10 @@ def CTSAnalysis(dnac, dnac_core):
     mergedlist = []
     mergedlist.extend(auth_cmd_list)
     mergedlist.extend(cts_cmd_list)
-    ret = dnac.command_run(mergedlist, edges)
-    for responses in ret:
-        ParseCommands.ParseSingleDev(responses["output"], responses["host"], dnac_core)
+    ret = dnac.command_run(mergedlist, edges, parser(dnac, dnac_core))
     Analysis.CheckAuth(dnac, dnac_core)
     Analysis.CheckCTS(dnac, dnac_core)
-    printraw(ret)
+    printraw(dnac, ret)
     return
 
 
@@ -271,34 +364,29 @@ def DatabaseAnalysis(dnac, dnac_core):
     for edge_dev in edge:
         edges.append(edge[edge_dev]["id"])
     if len(edges) > 0:
-        ret = dnac.command_run(db_cmd_list, edges)
-        for responses in ret:
-            ParseCommands.ParseSingleDev(responses["output"], responses["host"], dnac_core)
+        ret = dnac.command_run(db_cmd_list, edges, parser(dnac, dnac_core))
         print(f"Completed import on {len(edges)} edges")
     failed = Analysis.LispDBAnalysis(dnac, dnac_core)
-    printraw(ret)
+    printraw(dnac, ret)
     return
 
 
 def MapCacheAnalysis(dnac, dnac_core):
     devices_id_list = BuildIdlist(dnac, dnac_core, ["EDGENODE", "BORDERNODE"])
     if len(devices_id_list) > 0:
-        ret = dnac.command_run(mc_cmd_list, devices_id_list)
-        for responses in ret:
-            ParseCommands.ParseSingleDev(responses["output"], responses["host"], dnac_core)
+        ret = dnac.command_run(mc_cmd_list, devices_id_list, parser(dnac, dnac_core))
     Analysis.CheckEdgeMC(dnac, dnac_core)
-    printraw(ret)
+    printraw(dnac, ret)
     return
 
 
 def ReachabilityAnalysis(dnac, dnac_core):
     devices_id_list = BuildIdlist(dnac, dnac_core, ["EDGENODE", "BORDERNODE"])
     if len(devices_id_list) > 0:
-        ret = dnac.command_run(["show ip route", "show clns neigh detail", "show bfd neigh detail"], devices_id_list)
-        for responses in ret:
-            ParseCommands.ParseSingleDev(responses["output"], responses["host"], dnac_core)
+        ret = dnac.command_run(["show ip route", "show clns neigh detail", "show bfd neigh detail"], devices_id_list,
+                               parser(dnac, dnac_core))
     Analysis.CheckRLOCreach(dnac, dnac_core)
-    printraw(ret)
+    printraw(dnac, ret)
     return
 
 
@@ -317,11 +405,24 @@ def McastUnderlay(dnac, dnac_core):
         mcastcmds.append(f"show device-tracking database")
         mcastcmds.append(f"show mac address-table")
     if len(devices_id_list) > 0:
-        ret = dnac.command_run(mcastcmds, devices_id_list)
-        for responses in ret:
-            ParseCommands.ParseSingleDev(responses["output"], responses["host"], dnac_core)
+        ret = dnac.command_run(mcastcmds, devices_id_list, parser(dnac, dnac_core))
     Analysis.UnderlayMcastAnalysis(dnac, dnac_core, mcastunder)
-    printraw(ret)
+    printraw(dnac, ret)
+    return
+
+
+# Shows the most recent output of a command on a device from the logs of this and earlier sessions
+def LastOutput(dnac):
+    hostname = input("Device hostname:")
+    command = input("Command:")
+    dnac.logger.flush()
+    parent = os.path.dirname(dnac.logdir)
+    logdirs = [os.path.join(parent, logdir) for logdir in os.listdir(parent) if re.match(r"^log\d+_\d+$", logdir)]
+    output = LogWriter.last_output(logdirs, hostname, command)
+    if output is None:
+        print(f"No output of {command} on {hostname} found in the logs")
+    else:
+        print(output)
     return
 
 
@@ -337,6 +438,8 @@ def Menu(dnac, dnac_core):
         print(f"7: IP Multicast Underlay checks")
         print(f"d: Dump Datastructures")
         print(f"r: New Fabric Selection")
+        print(f"c: Clear cached DNAC responses")
+        print(f"l: Show last logged output of a command")
         print(f"q: Quit")
         choice = input("Choice:").lower()
         if choice == "1":
@@ -355,6 +458,13 @@ def Menu(dnac, dnac_core):
             print(dnac_core.printit())
         elif choice == "r":
             return
+        elif choice == "c":
+            dnac.cache.invalidate()
+            dnac.configs.invalidate()
+            dnac.parsed.invalidate()
+            print("Cached DNAC responses removed")
+        elif choice == "l":
+            LastOutput(dnac)
         elif choice == "q":
             exit()
         elif choice == "6":
@@ -368,19 +478,38 @@ def main(argv):
     fabric = None
     logdir = None
     debug = False
+    workers = None
+    clearcache = False
+    compress = False
+    record = None
+    replay = None
+    realtime = False
+    budgets = {}
+    usage = 'SDA_Digger.py -d <DNAC IP> -u <username> -p <password> -f <fabric> -l <logdirectory> -w <jobs> -c -z ' \
+            '-r <family=requests per minute,...> --record <cassette> --replay <cassette> --realtime'
     try:
-        opts, args = getopt.getopt(argv, "hxd:u:p:f:d:l:b:", ["directory="])
+        opts, args = getopt.getopt(argv, "hxczd:u:p:f:d:l:b:w:r:", ["directory=", "record=", "replay=", "realtime"])
     except getopt.GetoptError:
-        print('SDA_Digger.py -d <DNAC IP> -u <username> -p <password> -f <fabric> -l <logdirectory>')
+        print(usage)
         sys.exit(2)
     for opt, arg in opts:
         if opt == '-h':
-            print('SDA_Digger.py -d <DNAC IP> -u <username> -p <password> -f <fabric> -l <logdirectory>')
+            print(usage)
             sys.exit()
         elif opt == "-d":
             dnac = arg
         elif opt == "-x":
             debug = True
+        elif opt == "-c":
+            clearcache = True
+        elif opt == "-z":
+            compress = True
+        elif opt == "--record":
+            record = arg
+        elif opt == "--replay":
+            replay = arg
+        elif opt == "--realtime":
+            realtime = True
         elif opt in "-u":
             username = arg
         elif opt in "-p":
@@ -389,22 +518,49 @@ def main(argv):
             fabric = arg
         elif opt in "-l":
             logdir = arg
+        elif opt in "-w":
+            if not arg.isdigit() or int(arg) < 1:
+                print(usage)
+                sys.exit(2)
+            workers = int(arg)
+        elif opt == "-r":
+            for budget in arg.split(","):
+                family, rate = budget.split("=")
+                budgets[family.strip()] = int(rate)
         elif opt in "-b":
             inputdir = arg
             dnac_core = AnalysisCore.Analysis_Core()
             ParseBundle.ParseBundle(dnac_core, inputdir)
             exit()
+    if replay is not None:
+        # the cassette answers all requests, no DNAC or credentials needed
+        dnac = "replay" if dnac is None else dnac
+        username = "" if username is None else username
+        password = "" if password is None else password
     if dnac is None:
         dnac = input("DNAC IP address :")
     if username is None:
         username = input("username :")
     if password is None:
         password = getpass()
-    dnac = DNAC_Connector.DnacCon(dnac, username, password, logdir)
+    dnac = DNAC_Connector.DnacCon(dnac, username, password, logdir, record, replay, realtime)
     if debug is True:
         dnac.debug = True
+    if compress is True:
+        dnac.logger.compress = True
+    if clearcache is True:
+        dnac.cache.invalidate()
+        dnac.configs.invalidate()
+        dnac.parsed.invalidate()
+    dnac.limiter.budgets.update(budgets)
+    if workers is not None:
+        dnac.workers = workers
+        # one connection per worker thread with room for the pipeline stages
+        dnac.pool.size = max(dnac.pool.size, workers + 2)
     while True:
         dnac_core = AnalysisCore.Analysis_Core()
+        # lets the output checker compare instance outputs against the configured LISP instances
+        dnac.checker.dnac_core = dnac_core
         build_hierarch(dnac, dnac_core)
         Build_Lisp_Fabric(dnac, dnac_core, fabric)
         Menu(dnac, dnac_core)